@@ -7,20 +7,18 @@ class Compiler(object):
     #a parser that parses tokens into xml
     def __init__(self, tokens):
         '''
-        Initialize a token generator generates pairs of (token_type, token)
+        Initialize a token cursor over tokens, a tokenizer.TokenStream or any
+        iterable of pairs of (token_type, token)
         '''
-        self.generator = ((type, token) for (type, token) in tokens)
-        self.type, self.token = self.generator.next()
+        self.cursor = tokenizer.TokenCursor(tokens)
+        self.type, self.token = self.cursor.peek()
 
     def advance(self):
         '''
-        Advances generator to generate new pairs of (token_type, token), stops
-        when generator raises StopIteration, only called within compileTerminal()
+        Advances the cursor to the next pair of (token_type, token), only
+        called within compileTerminal()
         '''
-        try:
-            self.type, self.token = self.generator.next()
-        except StopIteration:
-            pass
+        self.type, self.token = self.cursor.advance()
 
     def compileTerminal(self, word = None):
         '''
@@ -38,10 +36,20 @@ class Compiler(object):
         return xml
 
     def compileClass(self):
+        '''
+        compiling class, an error raised gives the line and column of the
+        token it failed at
+        '''
         xml = "<class>\n"
-        xml += self.compileTerminal("class") + self.compileTerminal("className") +\
-        self.compileTerminal("{") + self.compileClassVarDec() + \
-        self.compileSubroutineDec() + self.compileTerminal("}")
+        try:
+            xml += self.compileTerminal("class") + self.compileTerminal("className") +\
+            self.compileTerminal("{") + self.compileClassVarDec() + \
+            self.compileSubroutineDec() + self.compileTerminal("}")
+        except Exception as e:
+            error = self.cursor.error(e)
+            if error is e:
+                raise
+            raise error from e
         xml += "</class>\n"
 
         return xml
@@ -250,8 +258,7 @@ class Xml(object):
         write T.xml for a single file
         '''
         with open(filename, "r") as f:
-            _, tokens = self.Tokenizer.tokenize(f.read())
-            compiler = Compiler(tokens)
+            compiler = Compiler(self.Tokenizer.stream(f.read()))
             xml = compiler.compileClass()
             with open (filename[:-5] + ".xml", "w") as outf:
                 outf.write(xml)
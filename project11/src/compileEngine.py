@@ -1,14 +1,15 @@
 import symbolTable
+import tokenizer
 import vmwriter
 
 class CompileEngine(object):
-    def __init__(self, generator, filename):
+    def __init__(self, tokens, filename):
         '''
-        Initialize a token generator generates pairs of (token_type, token)
+        Initialize a token cursor over tokens, a tokenizer.TokenStream or any
+        iterable of pairs of (token_type, token)
         '''
-        # self.generator = ((type, token) for (type, token) in tokens)
-        self.generator = generator
-        self.type, self.token = self.generator.next()
+        self.cursor = tokenizer.TokenCursor(tokens)
+        self.type, self.token = self.cursor.peek()
         self.className = None
         self.subroutineName = None
         self.symbolTable = symbolTable.SymbolTable()
@@ -18,13 +19,10 @@ class CompileEngine(object):
 
     def advance(self):
         '''
-        Advances generator to generate new pairs of (token_type, token), stops
-        when generator raises StopIteration, only called within compileTerminal()
+        Advances the cursor to the next pair of (token_type, token), only
+        called within compileTerminal()
         '''
-        try:
-            self.type, self.token = self.generator.next()
-        except StopIteration:
-            pass
+        self.type, self.token = self.cursor.advance()
 
     def compileTerminal(self, word = None):
         '''
@@ -41,14 +39,24 @@ class CompileEngine(object):
     def compileClass(self):
         '''
         compiling class, the whole step for compiling any files
+        the vmwriter is aborted when compiling fails, so that a consumer
+        waiting on its sink gets the error instead of waiting forever; the
+        error raised gives the line and column of the token it failed at
         '''
-        self.compileTerminal("class")
-        self.className = self.token
-        self.compileTerminal("className")
-        self.compileTerminal("{")
-        self.compileClassVarDec()
-        self.compileSubroutineDec()
-        self.compileTerminal("}")
+        try:
+            self.compileTerminal("class")
+            self.className = self.token
+            self.compileTerminal("className")
+            self.compileTerminal("{")
+            self.compileClassVarDec()
+            self.compileSubroutineDec()
+            self.compileTerminal("}")
+        except Exception as e:
+            error = self.cursor.error(e)
+            self.vmwriter.abort(error)
+            if error is e:
+                raise
+            raise error from e
 
         self.vmwriter.close()
 
@@ -177,12 +185,11 @@ class CompileEngine(object):
 
     def compileLet(self):
         self.compileTerminal("let")
-        varName = self.token
+        symbol = self.symbolTable.resolve(self.token)
         self.compileTerminal("varName")
         if self.token == "[":
             #when manipulating array
-            self.vmwriter.writePush(self.symbolTable.kindOf(varName), \
-                self.symbolTable.indexOf(varName))
+            self.vmwriter.writePush(symbol.kind, symbol.index)
             self.compileTerminal("[")
             self.compileExpression()
             self.vmwriter.writeArithmetic("add")
@@ -197,8 +204,7 @@ class CompileEngine(object):
             #when assigning values to ordinary variables
             self.compileTerminal("=")
             self.compileExpression()
-            self.vmwriter.writePop(self.symbolTable.kindOf(varName), \
-                self.symbolTable.indexOf(varName))
+            self.vmwriter.writePop(symbol.kind, symbol.index)
         self.compileTerminal(";")
 
     def compileIf(self):
@@ -326,13 +332,15 @@ class CompileEngine(object):
         elif self.type == "identifier":
             identifier = self.token
             # when expressions are identifiers
-            # it could be one of varName|varName'['expression']'|subRoutineCall
+            # it could be one of varName|varName'['expression']'|subRoutineCall,
+            # told apart by the token after the identifier
+            following = self.cursor.peek(1)[1]
+            symbol = self.symbolTable.resolve(identifier)
             self.compileTerminal("varName|subroutineName|className")
 
-            if self.token == "[":
+            if following == "[":
                 #varName "[" expression "]"
-                self.vmwriter.writePush(self.symbolTable.kindOf(identifier), \
-                    self.symbolTable.indexOf(identifier))
+                self.vmwriter.writePush(symbol.kind, symbol.index)
                 self.compileTerminal("[")
                 self.compileExpression()
                 self.compileTerminal("]")
@@ -340,7 +348,7 @@ class CompileEngine(object):
                 self.vmwriter.writePop("pointer", 1)
                 self.vmwriter.writePush("that", 0)
 
-            elif self.token == "(":
+            elif following == "(":
                 #subroutineName "(" expressionList ")"
                 #the function call must be a method within an outer method that
                 #takes the object of his as both's first argument
@@ -352,14 +360,14 @@ class CompileEngine(object):
                 self.compileTerminal(")")
                 self.vmwriter.writeCall(fullSubName, argNum)
 
-            elif self.token == ".":
+            elif following == ".":
                 #(className|varName)"."subroutineName "(" expressionList ")"
                 argNum = 0
                 self.compileTerminal(".")
                 subroutineName = self.token
                 self.compileTerminal("subroutineName")
                 self.compileTerminal("(")
-                if not self.symbolTable.typeOf(identifier):
+                if symbol is None:
                     #if identifier is not in symbolTable, it must be a className,
                     #and the function call must be a function instead of a method
                     fullSubName = identifier + "." + subroutineName
@@ -369,18 +377,15 @@ class CompileEngine(object):
                     #argNum plus one for including this
                     argNum = 1
                     # push this
-                    self.vmwriter.writePush(self.symbolTable.kindOf(identifier),\
-                        self.symbolTable.indexOf(identifier))
-                    fullSubName = self.symbolTable.typeOf(identifier) + "." + \
-                        subroutineName
+                    self.vmwriter.writePush(symbol.kind, symbol.index)
+                    fullSubName = symbol.type + "." + subroutineName
                 argNum += self.compileExpressionList()
                 self.compileTerminal(")")
                 self.vmwriter.writeCall(fullSubName, argNum)
 
             else:
                 #varName
-                self.vmwriter.writePush(self.symbolTable.kindOf(identifier), \
-                    self.symbolTable.indexOf(identifier))
+                self.vmwriter.writePush(symbol.kind, symbol.index)
 
         elif self.token == "(":
             #"(" expression ")"
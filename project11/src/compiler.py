@@ -1,21 +1,75 @@
-import sys
+import argparse
 import glob
+import hashlib
+import multiprocessing
 import os
+import sys
+import time
 import tokenizer
 import compileEngine
+import vmwriter
+
+#bumped whenever the layout of the build cache changes
+CACHE_VERSION = 1
 
 class Compiler(object):
-    def __init__(self):
+    def __init__(self, jobs=1, cacheDir=None):
         self.Tokenizer = tokenizer.Tokenizer()
+        #number of processes compiling files, see compileParallel
+        self.jobs = jobs
+        #directory of the build cache, when set a file whose source and
+        #compiler are unchanged since a previous run is not compiled again
+        self.cacheDir = cacheDir
+        self.version = compilerVersion() if cacheDir else None
+        #(filename, error message or None, seconds, taken from the cache) of
+        #every file compiled
+        self.results = []
 
     def compileSingleFile(self, filename):
         '''
-        Compile a single file
+        Compile a single file, the .vm file only replaces the previous one
+        once the whole class is compiled
         '''
+        start = time.time()
         with open(filename, "r") as f:
-            CE = compileEngine.CompileEngine(self.Tokenizer.tokenize(f.read()), \
-            filename[:-5] + ".vm")
-            CE.compileClass()
+            text = f.read()
+        vmname = filename[:-5] + ".vm"
+        #the vm code of a class depends only on its own source, the cache
+        #holds it under a hash of the source and of the compiler
+        entry, vm = None, None
+        if self.cacheDir:
+            key = hashlib.sha1((self.version + text).encode("utf-8")).hexdigest()
+            entry = os.path.join(self.cacheDir, key + ".vm")
+            vm = readFile(entry)
+        if vm is not None:
+            if readFile(vmname) != vm:
+                writeAtomic(vmname, vm)
+            self.results.append((filename, None, time.time() - start, True))
+            return
+
+        sink = vmwriter.listSink()
+        CE = compileEngine.CompileEngine(self.Tokenizer.stream(text), sink)
+        CE.compileClass()
+        vm = sink.text()
+        writeAtomic(vmname, vm)
+        if entry is not None:
+            #workers of compileParallel may create the directory at once
+            os.makedirs(self.cacheDir, exist_ok=True)
+            writeAtomic(entry, vm)
+        self.results.append((filename, None, time.time() - start, False))
+
+    def compileParallel(self, filenames):
+        '''
+        Compile every file in a worker of a process pool, a file failing to
+        compile is recorded in self.results and does not stop the others
+        '''
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            jobs = [(filename, self.cacheDir) for filename in sorted(filenames)]
+            self.results.extend(pool.imap(_compileFile, jobs))
+        finally:
+            pool.close()
+            pool.join()
 
     def compile(self, path):
         '''
@@ -24,12 +78,88 @@ class Compiler(object):
         '''
         #path is a single file
         if path.endswith(".jack"):
-            self.compileSingleFile(path)
+            filenames = [path]
         #path is a directory
         else:
-            for filename in glob.glob(os.path.join(path, '*.jack')):
+            filenames = glob.glob(os.path.join(path, '*.jack'))
+        if self.jobs > 1:
+            self.compileParallel(filenames)
+        else:
+            for filename in filenames:
                 self.compileSingleFile(filename)
 
+    def cacheCounts(self):
+        '''
+        (hits, misses) of the build cache over the files compiled
+        '''
+        hits = sum(1 for _, _, _, cached in self.results if cached)
+        misses = sum(1 for _, error, _, cached in self.results if not cached and not error)
+        return hits, misses
+
+def compilerVersion():
+    '''
+    Hash of the modules generating vm code, any change to them invalidates
+    every entry of the build cache
+    '''
+    digest = hashlib.sha1(str(CACHE_VERSION).encode("utf-8"))
+    for module in (tokenizer, compileEngine, compileEngine.symbolTable, vmwriter):
+        with open(os.path.splitext(module.__file__)[0] + ".py", "rb") as inf:
+            digest.update(inf.read())
+    return digest.hexdigest()
+
+def readFile(name):
+    '''
+    Text of the file name, None when it cannot be read
+    '''
+    try:
+        with open(name, "r") as inf:
+            return inf.read()
+    except (IOError, OSError):
+        return None
+
+def writeAtomic(outname, text):
+    '''
+    Write text next to outname and rename it into place, outname is never
+    left holding half a file; the name of the temporary file is unique to
+    the process, as workers may write the same cache entry at once
+    '''
+    tmpname = "{}.{}.tmp".format(outname, os.getpid())
+    with open(tmpname, "w") as outf:
+        outf.write(text)
+    os.replace(tmpname, outname)
+
+def _compileFile(job):
+    #compile a single .jack file in a worker process of compileParallel,
+    #returns its entry of Compiler.results
+    filename, cacheDir = job
+    start = time.time()
+    compiler = Compiler(1, cacheDir)
+    try:
+        compiler.compileSingleFile(filename)
+    except Exception as e:
+        return filename, "{}: {}".format(type(e).__name__, e), time.time() - start, False
+    return compiler.results[0]
+
 if __name__ == "__main__":
-    X = Compiler()
-    X.compile(sys.argv[1])
+    argParser = argparse.ArgumentParser(description="Jack to VM code compiler")
+    argParser.add_argument("path", help=".jack file or directory of .jack files")
+    argParser.add_argument("--jobs", type=int, default=1,
+                           help="number of processes compiling files")
+    argParser.add_argument("--incremental", action="store_true",
+                           help="reuse and update the build cache in .jackcache next to the sources")
+    args = argParser.parse_args()
+
+    if args.incremental:
+        cacheDir = os.path.join(os.path.dirname(args.path) if args.path.endswith(".jack") else args.path,
+                                ".jackcache")
+    else:
+        cacheDir = None
+    X = Compiler(args.jobs, cacheDir)
+    X.compile(args.path)
+    if args.jobs > 1:
+        for filename, error, seconds, cached in X.results:
+            print("{}: {}".format(filename, error or "{:.3f}s{}".format(seconds, " (cached)" if cached else "")))
+    if args.incremental:
+        print("cache: {} hits, {} misses".format(*X.cacheCounts()))
+    if any(error for _, error, _, _ in X.results):
+        sys.exit(1)
@@ -0,0 +1,134 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import tokenizer
+import compileEngine
+import vmwriter
+
+#the vm translator and the assembler are the src directories of project8 and
+#project6 in this repository
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(ROOT, "project8", "src"), os.path.join(ROOT, "project6", "src")]
+import VMTranslator
+import assembler
+
+class Pipeline(object):
+    '''
+    Pipeline takes a Jack program all the way to Hack machine words in memory:
+    the compiler yields the vm lines of one class at a time, the vm translator
+    turns them into blocks of asm text and the assembler cleans and encodes
+    those, every stage pulling from the one before it through a generator;
+    the .vm and .asm files in between are written only when asked for
+    '''
+    #stages in the order the program goes through them
+    STAGES = ("compile", "translate", "assemble")
+
+    def __init__(self, path, optimize=False, peephole=False, keepVm=False, keepAsm=False):
+        self.path = path
+        #passed on to VMTranslator.translateStream
+        self.optimize = optimize
+        self.peephole = peephole
+        #write the .vm file of every class, and the .asm file of the program
+        self.keepVm = keepVm
+        self.keepAsm = keepAsm
+        #output files, named after the .jack file or the directory as
+        #VMTranslator names its .asm file
+        if path.endswith(".jack"):
+            self.filenames = [path]
+            self.outname = path[:-5]
+        else:
+            self.filenames = sorted(glob.glob(os.path.join(path, "*.jack")))
+            self.outname = os.path.join(path, os.path.basename(os.path.normpath(path)))
+        self.Tokenizer = tokenizer.Tokenizer()
+        #seconds spent in each stage, not counting the stages feeding it
+        self.times = dict((stage, 0.0) for stage in self.STAGES)
+        #assembler holding the symbols and machine words once run is done
+        self.assembler = None
+
+    def compileClasses(self):
+        '''
+        Compile every .jack file, yielding the vm code one line at a time
+        '''
+        for filename in self.filenames:
+            with open(filename, "r") as f:
+                tokens = self.Tokenizer.stream(f.read())
+            sink = vmwriter.listSink()
+            compileEngine.CompileEngine(tokens, sink).compileClass()
+            lines = sink.lines()
+            if self.keepVm:
+                with open(filename[:-5] + ".vm", "w") as outf:
+                    outf.write("".join(lines))
+            for line in lines:
+                yield line
+
+    def timed(self, stage, iterable):
+        '''
+        Pass the items of iterable on, adding the time spent producing each
+        of them to self.times[stage], stages feeding it included
+        '''
+        items = iter(iterable)
+        while True:
+            start = time.time()
+            item = next(items, None)
+            self.times[stage] += time.time() - start
+            if item is None:
+                return
+            yield item
+
+    def tee(self, blocks, outname):
+        '''
+        Pass blocks of text on, writing them to outname as well
+        '''
+        with open(outname, "w") as outf:
+            for block in blocks:
+                outf.write(block)
+                yield block
+
+    def run(self):
+        '''
+        Run the program through every stage
+        Output: assembler holding the machine words in output
+        '''
+        vm = self.timed("compile", self.compileClasses())
+        asm = VMTranslator.translateStream(vm, None, self.optimize, self.peephole)
+        if self.keepAsm:
+            asm = self.tee(asm, self.outname + ".asm")
+        asm = self.timed("translate", asm)
+        start = time.time()
+        self.assembler = assembler.assembler(assembler.textClean().clean(asm))
+        self.assembler.firstPass()
+        self.assembler.secondPass()
+        self.times["assemble"] = time.time() - start
+        #the time of every stage includes the stages it pulled from
+        self.times["assemble"] -= self.times["translate"]
+        self.times["translate"] -= self.times["compile"]
+        return self.assembler
+
+    def toBinary(self, outname=None):
+        '''
+        Write the machine words of the program as a .hack file
+        '''
+        with open(outname or self.outname + ".hack", "w") as outf:
+            outf.write("".join(["{0:016b}\n".format(word) for word in self.assembler.output]))
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="Jack to Hack machine language, in memory")
+    argParser.add_argument("path", help=".jack file or directory of .jack files")
+    argParser.add_argument("--optimize", action="store_true",
+                           help="share one call and one return routine between all calls")
+    argParser.add_argument("--peephole", action="store_true",
+                           help="run the assembly through the peephole optimizer")
+    argParser.add_argument("--keep-vm", action="store_true",
+                           help="also write the .vm file of every class")
+    argParser.add_argument("--keep-asm", action="store_true",
+                           help="also write the .asm file of the program")
+    args = argParser.parse_args()
+
+    p = Pipeline(args.path, args.optimize, args.peephole, args.keep_vm, args.keep_asm)
+    p.run()
+    p.toBinary()
+    for stage in Pipeline.STAGES:
+        print("{}: {:.3f}s".format(stage, p.times[stage]))
+    print("{} instructions".format(len(p.assembler.output)))
@@ -1,11 +1,27 @@
+class Symbol(object):
+    '''
+    Symbol is the record of a variable in the symbolTable
+    '''
+    __slots__ = ("type", "kind", "index")
+
+    def __init__(self, type, kind, index):
+        self.type = type
+        self.kind = kind
+        self.index = index
+
 class SymbolTable(object):
     '''
-    SymbolTable class has a classTable and a subroutineTable to keep track of
-    all symbols of variables in a class
+    SymbolTable class keeps track of all symbols of variables in a class:
+    every symbol in scope is kept in a single hashmap by name, so resolving
+    a name is one lookup, and every open scope records the names it defined
+    and the symbols they hid, so closing a scope puts those back; the class
+    scope is always open, with the subroutine scope on top of it and
+    possibly nested scopes on top of that
     '''
     def __init__(self):
-        self.classTable = {}
-        self.subroutineTable = {}
+        self.symbols = {}
+        #for every open scope, (name, symbol it hides or None) of each definition
+        self.scopes = [[], []]
         self.count = {"static": 0,
                       "field": 0,
                       "argument": 0,
@@ -13,46 +29,68 @@ class SymbolTable(object):
 
     def define(self, name, type, kind):
         '''
-        Define a symbol in the symbolTable
+        Define a symbol in the symbolTable, static and field variables go in
+        the class scope, arguments and locals in the innermost scope
         '''
         index = self.count[kind]
         self.count[kind] += 1
-        if kind in {"static", "field"}:
-            self.classTable[name] = {"type": type,
-                                     "kind": kind,
-                                     "index": index}
-        elif kind in {"argument", "local"}:
-            self.subroutineTable[name] = {"type": type,
-                                          "kind": kind,
-                                          "index": index}
+        scope = self.scopes[0] if kind in {"static", "field"} else self.scopes[-1]
+        scope.append((name, self.symbols.get(name)))
+        self.symbols[name] = Symbol(type, kind, index)
+
+    def pushScope(self):
+        '''
+        Open a scope nested in the current one, locals defined in it keep
+        counting from the locals of the enclosing scopes
+        '''
+        self.scopes.append([])
+
+    def popScope(self):
+        '''
+        Close the innermost scope, its names resolve as they did before it
+        was opened
+        '''
+        self.unwind(self.scopes.pop())
+
+    def unwind(self, scope):
+        '''
+        Undo every definition made in scope and empty it in place
+        '''
+        for name, hidden in reversed(scope):
+            if hidden is None:
+                del self.symbols[name]
+            else:
+                self.symbols[name] = hidden
+        scope.clear()
 
     def resetSubroutineTable(self):
-        self.subroutineTable = {}
+        '''
+        Empty the subroutine scope for the next subroutine, the scope is
+        reused rather than reallocated, scopes nested in it are closed
+        '''
+        while len(self.scopes) > 2:
+            self.popScope()
+        self.unwind(self.scopes[1])
         self.count["argument"] = self.count["local"] = 0
 
     def varCount(self, kind):
         return self.count[kind]
 
+    def resolve(self, name):
+        '''
+        Symbol a name resolves to, with its kind, type and index, None when
+        the name is not a variable
+        '''
+        return self.symbols.get(name)
+
     def kindOf(self, name):
-        if name in self.subroutineTable:
-            return self.subroutineTable[name]["kind"]
-        elif name in self.classTable:
-            return self.classTable[name]["kind"]
-        else:
-            return None
+        symbol = self.symbols.get(name)
+        return symbol.kind if symbol is not None else None
 
     def typeOf(self, name):
-        if name in self.subroutineTable:
-            return self.subroutineTable[name]["type"]
-        elif name in self.classTable:
-            return self.classTable[name]["type"]
-        else:
-            return None
+        symbol = self.symbols.get(name)
+        return symbol.type if symbol is not None else None
 
     def indexOf(self, name):
-        if name in self.subroutineTable:
-            return self.subroutineTable[name]["index"]
-        elif name in self.classTable:
-            return self.classTable[name]["index"]
-        else:
-            return None
+        symbol = self.symbols.get(name)
+        return symbol.index if symbol is not None else None
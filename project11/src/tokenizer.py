@@ -1,62 +1,224 @@
+import array
 import re
+import string
+import sys
+
+#type codes of the tokens in a TokenStream, TYPES maps a code to its type
+KEYWORD, SYMBOL, INTEGER_CONSTANT, STRING_CONSTANT, IDENTIFIER = range(5)
+TYPES = ("keyword", "symbol", "integerConstant", "stringConstant", "identifier")
+CODES = dict((type, code) for code, type in enumerate(TYPES))
+
+class TokenStream(object):
+    '''
+    TokenStream keeps the tokens of a file in parallel arrays, a small integer
+    type code, the interned text, and the line and column the token starts
+    at, instead of a tuple per token; indexing and iteration give back the
+    (type, token) pairs of Tokenizer.tokenize
+    '''
+    def __init__(self):
+        self.types = array.array("B")
+        self.texts = []
+        self.lines = array.array("I")
+        self.columns = array.array("I")
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, i):
+        return (TYPES[self.types[i]], self.texts[i])
+
+    def __iter__(self):
+        for code, text in zip(self.types, self.texts):
+            yield (TYPES[code], text)
+
+    def position(self, i):
+        '''
+        (line, column) the i-th token starts at, both counted from 1
+        '''
+        return self.lines[i], self.columns[i]
+
+class TokenCursor(object):
+    '''
+    TokenCursor walks the tokens of a file for the compilation engine, kept
+    in arrays so that the current token and any token after it are read by
+    index without consuming anything, types are kept as type codes and only
+    turned into their names when read; reading past the end gives the last
+    token again, as advancing past the end of a generator used to
+    '''
+    def __init__(self, tokens):
+        #tokens is a TokenStream or any iterable of (type, token) pairs
+        if isinstance(tokens, TokenStream):
+            self.stream = tokens
+            self.types = tokens.types
+            self.texts = tokens.texts
+        else:
+            self.stream = None
+            pairs = list(tokens)
+            self.types = array.array("B", [CODES[type] for type, _ in pairs])
+            self.texts = [token for _, token in pairs]
+        #index of the current token and of the last one
+        self.i = 0
+        self.last = len(self.texts) - 1
+
+    def peek(self, k=0):
+        '''
+        (type, token) k tokens after the current one
+        '''
+        i = self.i + k
+        if i > self.last:
+            i = self.last
+        return TYPES[self.types[i]], self.texts[i]
+
+    def advance(self):
+        '''
+        Move on to the next token
+        Output: (type, token) of the token moved to
+        '''
+        i = self.i
+        if i < self.last:
+            i = self.i = i + 1
+        return TYPES[self.types[i]], self.texts[i]
+
+    def position(self):
+        '''
+        (line, column) of the current token, None when the tokens came
+        without positions
+        '''
+        if self.stream is None:
+            return None
+        return self.stream.position(self.i)
+
+    def error(self, error):
+        '''
+        ValueError for error raised while compiling the current token, with
+        the line and column of the token, error itself when the tokens came
+        without positions
+        '''
+        position = self.position()
+        if position is None:
+            return error
+        return ValueError("line {}, column {}: {}: {}".format(position[0], position[1],
+                                                              type(error).__name__, error))
 
 class Tokenizer(object):
+    '''
+    Tokenizer splits the text of a .jack file into tokens with a single
+    precompiled regex scanning the whole file buffer in one pass, the type of
+    every token is then read off a table by its text or its first character
+    '''
+    #symbols and keywords of the Jack language, every other word is an identifier
+    symbols = frozenset("{}()[].,;+-*/&|<>=~")
+    keywords = frozenset(["class", "constructor", "function", "method", "field",
+                          "static", "var", "int", "char", "boolean", "void", "true",
+                          "false", "null", "this", "let", "do", "if", "else", "while",
+                          "return"])
+    #one alternative per lexical element, in the order they are tried: string
+    #constants come first so that nothing inside them is taken for a comment,
+    #comments are returned to be dropped, a "/*" left open and any other
+    #character outside white space are errors; there are no capture groups
+    #so that findall hands back the whole tokens without leaving C
+    scanner = re.compile(r'''"[^"\n]*"
+                            |//[^\n]*
+                            |/\*.*?\*/
+                            |/\*
+                            |[0-9]+
+                            |[A-Za-z_][A-Za-z0-9_]*
+                            |[{}()\[\].,;+\-*/&|<>=~]
+                            |\S''', re.DOTALL | re.VERBOSE)
+    #(type, token) pair of every keyword and symbol, shared by all their tokens
+    known = dict([(token, ("keyword", token)) for token in keywords] +
+                 [(token, ("symbol", token)) for token in symbols])
+    #type of the other tokens by their first character
+    kinds = dict([(ch, "identifier") for ch in string.ascii_letters + "_"] +
+                 [(ch, "integerConstant") for ch in string.digits])
+    #type code of every keyword and symbol, and of the other tokens by their
+    #first character, for stream
+    codes = dict([(token, KEYWORD) for token in keywords] + [(token, SYMBOL) for token in symbols])
+    codesByFirst = dict([(ch, IDENTIFIER) for ch in string.ascii_letters + "_"] +
+                        [(ch, INTEGER_CONSTANT) for ch in string.digits])
 
     def tokenize(self, text):
         '''
         Input text of a file, genrate tokens for the file
-        Output text to write to T.xml file and tokens array including tuple of type and token
-        '''
-        #clean up multi-line comments and tabs
-        text = re.sub("/\*.*?\*/", "", text, flags = re.DOTALL).replace("\t", " ")
-        #split text into lines, filtering empty lines, one-line comments, put
-        #splits into line generator
-        lines = (line.strip().split("//")[0].strip() for line in text.split("\n")\
-         if line.strip() and not line.strip().startswith("//"))
-
-        for line in lines:
-            n, i = len(line), 0
-            token = ""
-            while i <= n:
-                #dealting with stringConstant
-                if token == '"':
-                    while line[i] != '"':
-                        token += line[i]
-                        i += 1
-                    token += line[i]
-                #white space or symbol is the cut-off between tokens, when encounter
-                #white space or symbol, put current token into tokens array, move on
-                #to generate next token
-                elif (len(token) == 1 and token in "{}()[].,;+-*/&|<>=~") or\
-                ((line[i] == " " or line[i] in "{}()[].,;+-*/&|<>=~") and token):
-
-                    type = self.type(token)
-                    token = token.replace('"', '')
-                    yield (type, token)
-
-                    if i < n:
-                        #skip white space
-                        if not line[i] == " ":
-                            token = line[i]
-                        else:
-                            token = ""
-                else:
-                    #skip white space
-                    if not line[i] == " ":
-                        token += line[i]
-                i += 1
+        Output generator of tuples of type and token
+        '''
+        known, kinds = self.known.get, self.kinds.get
+        for token in self.scanner.findall(text):
+            pair = known(token)
+            if pair is not None:
+                yield pair
+                continue
+            kind = kinds(token[0])
+            if kind is not None:
+                yield (kind, token)
+            elif token[0] == '"' and len(token) > 1:
+                yield ("stringConstant", token[1:-1])
+            elif token[0] != "/" or token == "/*":
+                self.error(text, token)
+
+    def stream(self, text):
+        '''
+        Input text of a file, tokenize it into a TokenStream, tokens with the
+        same text share a single string
+        '''
+        tokens = TokenStream()
+        types, texts = tokens.types, tokens.texts
+        lines, columns = tokens.lines, tokens.columns
+        codes, codesByFirst = self.codes.get, self.codesByFirst.get
+        intern = sys.intern
+        #line of the last token and offset its line starts at, newlines are
+        #only counted in the text between two tokens
+        line, lineStart, last = 1, 0, 0
+        for match in self.scanner.finditer(text):
+            token = match.group()
+            code = codes(token)
+            if code is None:
+                code = codesByFirst(token[0])
+                if code is None:
+                    if token[0] == '"' and len(token) > 1:
+                        code, token = STRING_CONSTANT, token[1:-1]
+                    elif token[0] != "/" or token == "/*":
+                        self.error(text, token)
+                    else:
+                        continue
+            token = intern(token)
+            start = match.start()
+            newlines = text.count("\n", last, start)
+            if newlines:
+                line += newlines
+                lineStart = text.rfind("\n", last, start) + 1
+            last = start
+            types.append(code)
+            texts.append(token)
+            lines.append(line)
+            columns.append(start - lineStart + 1)
+        return tokens
+
+    def error(self, text, token):
+        '''
+        Raise ValueError for a token no rule of the language accepts, with
+        the line of its first occurrence
+        '''
+        for match in self.scanner.finditer(text):
+            if match.group() == token:
+                line = text.count("\n", 0, match.start()) + 1
+                break
+        if token == "/*":
+            message = "unterminated comment"
+        elif token == '"':
+            message = "unterminated string constant"
+        else:
+            message = "unexpected character " + repr(token)
+        raise ValueError("line {}: {}".format(line, message))
 
     def type(self, token):
         '''
         Given token, return token type
         '''
-        if token in "{}()[].,;+-*/&|<>=~":
+        if token in self.symbols:
             return "symbol"
 
-        elif token in {"class", "constructor", "function", "method", "field", \
-                        "static", "var", "int", "char", "boolean", "void", "true",\
-                        "false", "null", "this", "let", "do", "if", "else", "while",\
-                        "return"}:
+        elif token in self.keywords:
             return "keyword"
 
         elif token.startswith('"'):
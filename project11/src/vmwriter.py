@@ -1,41 +1,141 @@
+import queue
+
+#line format of a command tuple by its length
+formats = (None, "%s\n", "%s %s\n", "%s %s %s\n")
+
+def vmLine(command):
+    '''
+    Line of vm code for a command tuple such as ("push", "local", 0) or ("add",)
+    '''
+    return formats[len(command)] % command
+
+class listSink(object):
+    '''
+    listSink keeps the commands written to it in memory as tuples, they are
+    only turned into text when asked for
+    '''
+    def __init__(self):
+        self.commands = []
+        self.add = self.commands.append
+
+    def close(self):
+        pass
+
+    def abort(self, error):
+        #the class failed to compile, nothing is written
+        pass
+
+    def lines(self):
+        return [vmLine(command) for command in self.commands]
+
+    def text(self):
+        return "".join(self.lines())
+
+class fileSink(listSink):
+    '''
+    fileSink writes the commands to a file in a single write once the class
+    is compiled
+    '''
+    def __init__(self, filename):
+        super(fileSink, self).__init__()
+        self.filename = filename
+
+    def close(self):
+        with open(self.filename, "w") as outf:
+            outf.write(self.text())
+
+class textSink(listSink):
+    '''
+    textSink writes the commands in a single write to an object with a write
+    method, such as an open file, which is left open
+    '''
+    def __init__(self, outf):
+        super(textSink, self).__init__()
+        self.outf = outf
+
+    def close(self):
+        self.outf.write(self.text())
+
+class queueSink(object):
+    '''
+    queueSink hands the commands over through a queue, so that a consumer,
+    in another thread for instance, works on them while the class is still
+    being compiled
+    '''
+    def __init__(self, maxsize=0):
+        self.queue = queue.Queue(maxsize)
+        self.add = self.queue.put
+
+    def close(self):
+        #marks the end of the commands for lines
+        self.queue.put(None)
+
+    def abort(self, error):
+        #marks the end of the commands, lines raises error there
+        self.queue.put(error)
+
+    def lines(self):
+        '''
+        Generator of the lines of vm code, until the sink is closed, raises
+        the error the class failed to compile with when it is aborted
+        '''
+        while True:
+            command = self.queue.get()
+            if command is None:
+                return
+            if isinstance(command, BaseException):
+                raise command
+            yield vmLine(command)
+
 class Vmwriter(object):
     '''
-    Vmwrite opens the output file path and write vm code compiled by the
-    compileEngine into the output file
+    Vmwrite collects the vm code compiled by the compileEngine as command
+    tuples and hands them to a sink: filename may be the output file path,
+    written in one go on close, an object with a write method, or any of
+    the sinks above
     '''
     def __init__(self, filename):
-        self.f = open(filename, "w")
+        if isinstance(filename, str):
+            self.sink = fileSink(filename)
+        elif hasattr(filename, "write"):
+            self.sink = textSink(filename)
+        else:
+            self.sink = filename
+        self.add = self.sink.add
 
     def writePush(self, segment, index):
         if segment == "field":
             segment = "this"
-        self.f.write("push {} {}\n".format(segment, index))
+        self.add(("push", segment, index))
 
     def writePop(self, segment, index):
         if segment == "field":
             segment = "this"
-        self.f.write("pop {} {}\n".format(segment, index))
+        self.add(("pop", segment, index))
 
     def writeArithmetic(self, arithmetic):
-        self.f.write(arithmetic + "\n")
+        self.add((arithmetic,))
 
     def writeLabel(self, label):
-        self.f.write("label {}\n".format(label))
+        self.add(("label", label))
 
     def writeGoto(self, label):
-        self.f.write("goto {}\n".format(label))
+        self.add(("goto", label))
 
     def writeIf(self, label):
-        self.f.write("if-goto {}\n".format(label))
+        self.add(("if-goto", label))
 
     def writeCall(self, functionName, argumentNumber):
-        self.f.write("call {} {}\n".format(functionName, argumentNumber))
+        self.add(("call", functionName, argumentNumber))
 
     def writeFunction(self, functionName, varNumber):
-        self.f.write("function {} {}\n".format(functionName, varNumber))
+        self.add(("function", functionName, varNumber))
 
     def writeReturn(self):
-        self.f.write("return\n")
+        self.add(("return",))
 
     def close(self):
-        self.f.close()
+        self.sink.close()
+
+    def abort(self, error):
+        self.sink.abort(error)
@@ -0,0 +1,1026 @@
+import argparse
+import array
+import os
+import re
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class hdlError(Exception):
+    '''
+    Raised for malformed HDL or test scripts, for chips that cannot be wired
+    together and for failed comparisons
+    '''
+
+#tokens of an .hdl file, white spaces and comments are skipped
+hdlToken = re.compile(r"(?P<skip>\s+|//[^\n]*|/\*.*?\*/)|"
+                      r"(?P<token>\.\.|[A-Za-z_]\w*|\d+|[{}()\[\],;=:])|(?P<bad>.)", re.DOTALL)
+
+class chipDef(object):
+    '''
+    chipDef holds the interface and parts of a chip as parsed from HDL
+    inputs/outputs: list of (pin, width)
+    parts: list of (chipName, connections), each connection being
+    (pin, pinRange, target, targetRange) with ranges (lo, hi) or None
+    builtin: name of the builtin implementation, None for chips built of parts
+    '''
+    def __init__(self, name, inputs, outputs, parts=(), builtin=None):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.parts = list(parts)
+        self.builtin = builtin
+        self.widths = dict(self.inputs + self.outputs)
+
+class hdlParser(object):
+    '''
+    Recursive descent parser for one CHIP definition
+    '''
+    def __init__(self, text, filename="<hdl>"):
+        self.filename = filename
+        self.tokens = []
+        for match in hdlToken.finditer(text):
+            if match.lastgroup == "bad":
+                raise hdlError("{}: unexpected character {!r}".format(filename, match.group()))
+            if match.lastgroup == "token":
+                self.tokens.append(match.group())
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise hdlError("{}: expected {} but found {}".format(self.filename, expected or "more input", token))
+        self.pos += 1
+        return token
+
+    def parseChip(self):
+        self.next("CHIP")
+        name = self.next()
+        self.next("{")
+        inputs = self.parsePinDecls("IN") if self.peek() == "IN" else []
+        outputs = self.parsePinDecls("OUT") if self.peek() == "OUT" else []
+        parts, builtin = [], None
+        if self.peek() == "BUILTIN":
+            self.next()
+            builtin = self.next()
+            self.next(";")
+            if self.peek() == "CLOCKED":
+                #builtin chips already know which of their pins are clocked
+                while self.next() != ";":
+                    pass
+        else:
+            self.next("PARTS")
+            self.next(":")
+            while self.peek() != "}":
+                parts.append(self.parsePart())
+        self.next("}")
+        return chipDef(name, inputs, outputs, parts, builtin)
+
+    def parsePinDecls(self, keyword):
+        self.next(keyword)
+        pins = []
+        while True:
+            pin = self.next()
+            width = 1
+            if self.peek() == "[":
+                self.next()
+                width = int(self.next())
+                self.next("]")
+            pins.append((pin, width))
+            if self.next() == ";":
+                return pins
+
+    def parsePart(self):
+        name = self.next()
+        self.next("(")
+        connections = []
+        while True:
+            pin, pinRange = self.parsePinRef()
+            self.next("=")
+            target, targetRange = self.parsePinRef()
+            connections.append((pin, pinRange, target, targetRange))
+            if self.next() == ")":
+                break
+        self.next(";")
+        return (name, connections)
+
+    def parsePinRef(self):
+        pin = self.next()
+        if self.peek() != "[":
+            return pin, None
+        self.next()
+        lo = hi = int(self.next())
+        if self.peek() == "..":
+            self.next()
+            hi = int(self.next())
+        self.next("]")
+        return pin, (lo, hi)
+
+def parseHdl(filename):
+    with open(filename, "r") as inf:
+        return hdlParser(inf.read(), filename).parseChip()
+
+#Python expression of every primitive gate over its input bits a, b (and sel)
+#in the generated evaluation code, M holds the all-ones value of one bit
+gateExpr = {"nand": "({a} & {b}) ^ M",
+            "and": "{a} & {b}",
+            "or": "{a} | {b}",
+            "xor": "{a} ^ {b}",
+            "not": "{a} ^ M",
+            "mux": "({a} & ({sel} ^ M)) | ({b} & {sel})"}
+
+class netlist(object):
+    '''
+    netlist is a chip flattened down to single-bit nets driven by primitive
+    gates, plus builtin clocked chips (stateChip) working on whole words
+    Nets 0 and 1 are the constants false and true
+    '''
+    FALSE, TRUE = 0, 1
+
+    def __init__(self):
+        self.size = 2
+        #(kind, out, ins) for every primitive gate, kind being a key of
+        #gateExpr or "buf" for a wire from ins[0] to out
+        self.gates = []
+        #(stateChip, {pin: nets}) for every builtin clocked chip
+        self.nodes = []
+
+    def new(self, width):
+        nets = list(range(self.size, self.size + width))
+        self.size += width
+        return nets
+
+    def gate(self, kind, *ins):
+        '''
+        Add a primitive gate and return its output net, gates with constant
+        inputs are folded away
+        '''
+        F, T = self.FALSE, self.TRUE
+        if kind == "not" and ins[0] in (F, T):
+            return T if ins[0] == F else F
+        if kind == "mux":
+            a, b, sel = ins
+            if sel in (F, T):
+                return b if sel == T else a
+            if a == b:
+                return a
+            if (a, b) == (F, T):
+                return sel
+        if kind in ("and", "or", "xor", "nand") and (ins[0] in (F, T) or ins[1] in (F, T)):
+            #const is the constant input, other the remaining one
+            const, other = (ins[0], ins[1]) if ins[0] in (F, T) else (ins[1], ins[0])
+            if kind == "and":
+                return other if const == T else F
+            if kind == "or":
+                return T if const == T else other
+            if kind == "xor":
+                return self.gate("not", other) if const == T else other
+            return self.gate("not", other) if const == T else T
+        if kind in ("and", "or") and ins[0] == ins[1]:
+            return ins[0]
+        out = self.new(1)[0]
+        self.gates.append((kind, out, ins))
+        return out
+
+    def wire(self, src, dst):
+        self.gates.append(("buf", dst, (src,)))
+
+    def instantiate(self, library, definition, pins):
+        '''
+        Flatten a chip into the netlist, pins mapping every pin of the chip
+        instance to its list of nets (bit 0 first)
+        '''
+        if definition.builtin:
+            builtin = builtinChips[definition.builtin]
+            if isinstance(builtin, type):
+                node = builtin()
+                node.name = definition.name
+                self.nodes.append((node, pins))
+            else:
+                outs = builtin(self, dict((pin, pins[pin]) for pin, _ in definition.inputs))
+                for pin, _ in definition.outputs:
+                    for src, dst in zip(outs[pin], pins[pin]):
+                        self.wire(src, dst)
+            return
+
+        local = dict(pins)
+
+        def nets(name, width):
+            #internal pins are created on first use with the width they are used with
+            if name not in local:
+                local[name] = self.new(width)
+            elif len(local[name]) != width and name not in definition.widths:
+                raise hdlError("{}: pin {} used with widths {} and {}".format(definition.name, name, len(local[name]), width))
+            return local[name]
+
+        def span(rng, width, what):
+            lo, hi = rng if rng else (0, width - 1)
+            if not 0 <= lo <= hi < width:
+                raise hdlError("{}: bad sub bus {}[{}..{}]".format(definition.name, what, lo, hi))
+            return lo, hi
+
+        for partName, connections in definition.parts:
+            part = library.get(partName)
+            inWidths, outWidths = dict(part.inputs), dict(part.outputs)
+            partPins = dict((pin, [self.FALSE] * width) for pin, width in part.inputs)
+            dests = dict((pin, [[] for i in range(width)]) for pin, width in part.outputs)
+
+            for pin, pinRange, target, targetRange in connections:
+                if pin in inWidths:
+                    lo, hi = span(pinRange, inWidths[pin], pin)
+                    if target in ("true", "false"):
+                        bits = [self.TRUE if target == "true" else self.FALSE] * (hi - lo + 1)
+                    else:
+                        if targetRange and target not in definition.widths:
+                            raise hdlError("{}: internal pin {} cannot be subscripted".format(definition.name, target))
+                        source = nets(target, definition.widths.get(target, hi - lo + 1))
+                        tlo, thi = span(targetRange, len(source), target)
+                        bits = source[tlo:thi + 1]
+                    if len(bits) != hi - lo + 1:
+                        raise hdlError("{}: width mismatch between {}.{} and {}".format(definition.name, partName, pin, target))
+                    partPins[pin][lo:hi + 1] = bits
+                elif pin in outWidths:
+                    lo, hi = span(pinRange, outWidths[pin], pin)
+                    if targetRange and target not in definition.widths:
+                        raise hdlError("{}: internal pin {} cannot be subscripted".format(definition.name, target))
+                    if target in definition.widths and target not in dict(definition.outputs) and target in local:
+                        raise hdlError("{}: {}.{} drives input pin {}".format(definition.name, partName, pin, target))
+                    sink = nets(target, definition.widths.get(target, hi - lo + 1))
+                    tlo, thi = span(targetRange, len(sink), target)
+                    if thi - tlo != hi - lo:
+                        raise hdlError("{}: width mismatch between {}.{} and {}".format(definition.name, partName, pin, target))
+                    for i in range(hi - lo + 1):
+                        dests[pin][lo + i].append(sink[tlo + i])
+                else:
+                    raise hdlError("{}: {} has no pin {}".format(definition.name, partName, pin))
+
+            for pin, width in part.outputs:
+                bits = []
+                for targets in dests[pin]:
+                    #the first net a bit goes to is driven directly, others by wires
+                    if targets:
+                        for other in targets[1:]:
+                            self.wire(targets[0], other)
+                        bits.append(targets[0])
+                    else:
+                        bits.append(self.new(1)[0])
+                partPins[pin] = bits
+            self.instantiate(library, part, partPins)
+
+    def resolveWires(self):
+        '''
+        Merge every net with the net its wire comes from and drop the wires
+        Output: function mapping a net to the net that now stands for it
+        '''
+        driven = set(out for kind, out, ins in self.gates if kind != "buf")
+        driven.update(n for node, pins in self.nodes for pin, _ in node.outputs for n in pins[pin])
+        alias = {}
+        for kind, out, ins in self.gates:
+            if kind == "buf":
+                if out in alias or out in driven or out in (self.FALSE, self.TRUE):
+                    raise hdlError("net {} has more than one driver".format(out))
+                alias[out] = ins[0]
+
+        def find(net):
+            seen = 0
+            while net in alias:
+                net = alias[net]
+                seen += 1
+                if seen > len(alias):
+                    raise hdlError("loop of wires")
+            return net
+
+        self.gates = [(kind, find(out), tuple(find(i) for i in ins)) \
+                      for kind, out, ins in self.gates if kind != "buf"]
+        self.nodes = [(node, dict((pin, [find(n) for n in nets]) for pin, nets in pins.items())) \
+                      for node, pins in self.nodes]
+        return find
+
+    def schedule(self):
+        '''
+        Order gates and clocked chips so that every unit comes after the units
+        driving its inputs, clocked chip outputs only depend on the inputs
+        listed in their combInputs
+        Output: list of ("gate", index) and ("node", index)
+        '''
+        units = [("gate", i) for i in range(len(self.gates))] + [("node", i) for i in range(len(self.nodes))]
+        driver, reads = {}, []
+        for unit in units:
+            kind, i = unit
+            if kind == "gate":
+                outs, ins = [self.gates[i][1]], self.gates[i][2]
+            else:
+                node, pins = self.nodes[i]
+                outs = [n for pin, _ in node.outputs for n in pins[pin]]
+                ins = [n for pin in node.combInputs for n in pins[pin]]
+            for net in outs:
+                if net in driver or net in (self.FALSE, self.TRUE):
+                    raise hdlError("net {} has more than one driver".format(net))
+                driver[net] = unit
+            reads.append(ins)
+
+        index = dict((unit, k) for k, unit in enumerate(units))
+        waiting = [0] * len(units)
+        users = [[] for unit in units]
+        for k, ins in enumerate(reads):
+            for dep in set(driver[net] for net in ins if net in driver):
+                waiting[k] += 1
+                users[index[dep]].append(k)
+
+        ready = [k for k in range(len(units)) if not waiting[k]]
+        order = []
+        while ready:
+            k = ready.pop()
+            order.append(units[k])
+            for user in users[k]:
+                waiting[user] -= 1
+                if not waiting[user]:
+                    ready.append(user)
+        if len(order) != len(units):
+            raise hdlError("combinational loop in the chip")
+        return order
+
+def gather(nets):
+    '''
+    Expression packing a list of bit nets into one integer
+    '''
+    terms = ["n[{}]".format(net) if i == 0 else "n[{}] << {}".format(net, i) \
+             for i, net in enumerate(nets) if net != netlist.FALSE]
+    return " | ".join(terms) or "0"
+
+def packVectors(values, width):
+    '''
+    Pack a batch of input values bit-parallel, one Python int per bit of
+    the pin: bit k of plane b is bit b of values[k]
+    '''
+    rows = [format(value & ((1 << width) - 1), "0{}b".format(width)) for value in values]
+    if not rows:
+        return [0] * width
+    #column width-1-b of the rows holds bit b of every value
+    return [int("".join(reversed(column)), 2) for column in reversed(list(zip(*rows)))]
+
+def unpackVectors(planes, count):
+    '''
+    Inverse of packVectors for count values
+    '''
+    if not planes:
+        return [0] * count
+    columns = [format(plane, "0{}b".format(count))[::-1][:count] for plane in reversed(planes)]
+    return [int("".join(row), 2) for row in zip(*columns)]
+
+def packArray(values, width):
+    '''
+    numpy flavour of packVectors, every plane is an array of uint64 words
+    holding 64 values each, vector k in bit k % 64 of word k // 64
+    '''
+    values = numpy.asarray(values, dtype=numpy.int64) & ((1 << width) - 1)
+    words = -(-len(values) // 64)
+    planes = []
+    for bit in range(width):
+        packed = numpy.packbits((values >> bit & 1).astype(numpy.uint8), bitorder="little")
+        packed = numpy.concatenate((packed, numpy.zeros(words * 8 - len(packed), numpy.uint8)))
+        planes.append(packed.view("<u8"))
+    return planes
+
+def unpackArray(planes, count):
+    '''
+    Inverse of packArray for count values
+    Output: numpy int64 array
+    '''
+    words = -(-count // 64)
+    values = numpy.zeros(count, numpy.int64)
+    for bit, plane in enumerate(planes):
+        #outputs tied to true or false come back as one shared word
+        plane = numpy.ascontiguousarray(numpy.broadcast_to(plane, (words,)), dtype="<u8")
+        bits = numpy.unpackbits(plane.view(numpy.uint8), bitorder="little")[:count]
+        values |= bits.astype(numpy.int64) << bit
+    return values
+
+class chip(object):
+    '''
+    chip is an HDL chip flattened into a netlist and compiled into Python
+    functions for evaluation and for the two halves of a clock cycle
+    '''
+    def __init__(self, hdlName, library=None):
+        self.library = library or chipLibrary([os.path.dirname(os.path.abspath(hdlName))])
+        if os.path.exists(hdlName):
+            definition = self.library.parse(hdlName)
+        else:
+            definition = self.library.get(os.path.splitext(os.path.basename(hdlName))[0])
+        self.definition = definition
+        self.nl = netlist()
+        pins = {}
+        for pin, width in definition.inputs + definition.outputs:
+            pins[pin] = self.nl.new(width)
+        self.nl.instantiate(self.library, definition, pins)
+        find = self.nl.resolveWires()
+        #nets of every pin of the chip
+        self.pins = dict((pin, [find(n) for n in nets]) for pin, nets in pins.items())
+        self.inputs = dict(definition.inputs)
+        self.outputs = dict(definition.outputs)
+        #clocked chips, by chip name, for test scripts referring to RAM16K[3] etc.
+        self.nodes = [node for node, pins in self.nl.nodes]
+        self.nodesByName = {}
+        for node in self.nodes:
+            self.nodesByName.setdefault(node.name, node)
+        self.compile()
+        #current value of every net
+        self.n = [0] * self.nl.size
+        self.n[netlist.TRUE] = 1
+        #clock: number of full cycles and whether the clock is high (after tick)
+        self.time = 0
+        self.high = False
+
+    def compile(self):
+        order = self.nl.schedule()
+        lines = ["def evaluate(n, M, nodes):"]
+        for kind, i in order:
+            if kind == "gate":
+                gate, out, ins = self.nl.gates[i]
+                args = dict(zip(("a", "b", "sel"), ["n[{}]".format(net) for net in ins]))
+                lines.append("    n[{}] = {}".format(out, gateExpr[gate].format(**args)))
+            else:
+                node, pins = self.nl.nodes[i]
+                args = ", ".join(gather(pins[pin]) for pin in node.combInputs)
+                lines.append("    r = nodes[{}].output({})".format(i, args))
+                for k, (pin, width) in enumerate(node.outputs):
+                    for bit, net in enumerate(pins[pin]):
+                        lines.append("    n[{}] = r[{}] >> {} & 1".format(net, k, bit))
+        lines.append("def tick(n, nodes):")
+        for i, (node, pins) in enumerate(self.nl.nodes):
+            args = ", ".join(gather(pins[pin]) for pin, _ in node.inputs)
+            lines.append("    nodes[{}].tick({})".format(i, args))
+        lines.append("    pass")
+        namespace = {}
+        exec(compile("\n".join(lines), "<chip {}>".format(self.definition.name), "exec"), namespace)
+        self.evaluateFn, self.tickFn = namespace["evaluate"], namespace["tick"]
+
+    def set(self, pin, value):
+        nets = self.pins[pin]
+        for bit, net in enumerate(nets):
+            self.n[net] = value >> bit & 1
+
+    def get(self, pin):
+        value = 0
+        for bit, net in enumerate(self.pins[pin]):
+            value |= self.n[net] << bit
+        return value
+
+    def eval(self):
+        self.evaluateFn(self.n, 1, self.nodes)
+
+    def evalPacked(self, planes, M):
+        '''
+        Evaluate the chip once for a whole batch of input vectors packed bit
+        parallel, every gate becomes one operation over all the vectors;
+        planes maps every input pin to one value per bit as built by
+        packVectors or packArray, M is the value with every vector bit set
+        (an int or a numpy array of uint64 words)
+        Output: dict mapping every output pin to its list of planes
+        '''
+        if self.nodes:
+            raise hdlError("{} has clocked parts, batch evaluation needs a combinational chip" \
+                           .format(self.definition.name))
+        zero = M ^ M
+        n = [zero] * self.nl.size
+        n[netlist.TRUE] = M
+        for pin in self.inputs:
+            for net, plane in zip(self.pins[pin], planes.get(pin, ())):
+                n[net] = plane
+        self.evaluateFn(n, M, self.nodes)
+        return dict((pin, [n[net] for net in self.pins[pin]]) for pin in self.outputs)
+
+    def evalBatch(self, vectors):
+        '''
+        Evaluate the chip for many input vectors, vectors maps input pins to
+        equal length sequences of values, missing pins are held at 0; with
+        numpy the vectors go through 64 to a machine word, without it one
+        arbitrary length int per bit carries the whole batch
+        Output: dict mapping every output pin to its values, one per vector
+        '''
+        count = len(next(iter(vectors.values()))) if vectors else 1
+        if numpy is not None:
+            pack, unpack = packArray, unpackArray
+            M = numpy.full(-(-count // 64), 0xFFFFFFFFFFFFFFFF, numpy.uint64)
+        else:
+            pack, unpack = packVectors, unpackVectors
+            M = (1 << count) - 1
+        planes = dict((pin, pack(values, self.inputs[pin])) for pin, values in vectors.items())
+        outputs = self.evalPacked(planes, M)
+        return dict((pin, unpack(planes, count)) for pin, planes in outputs.items())
+
+    def tick(self):
+        '''
+        Rising edge: settle the logic, then clocked chips sample their inputs
+        '''
+        self.eval()
+        self.tickFn(self.n, self.nodes)
+        self.high = True
+
+    def tock(self):
+        '''
+        Falling edge: clocked chips commit their new state, logic settles
+        '''
+        for node in self.nodes:
+            node.tock()
+        self.time += 1
+        self.high = False
+        self.eval()
+
+    def timeString(self):
+        return "{}{}".format(self.time, "+" if self.high else "")
+
+class chipLibrary(object):
+    '''
+    chipLibrary resolves chip names to definitions, looking for <name>.hdl
+    in every directory of path in turn and falling back on the builtin chips,
+    like the hardware simulator does for parts missing from a project
+    '''
+    def __init__(self, path):
+        self.path = list(path)
+        self.defs = {}
+
+    def parse(self, filename):
+        definition = parseHdl(filename)
+        if definition.builtin:
+            return self.builtinDef(definition.builtin, definition.name)
+        return definition
+
+    def get(self, name):
+        if name not in self.defs:
+            for directory in self.path:
+                filename = os.path.join(directory, name + ".hdl")
+                if os.path.exists(filename):
+                    self.defs[name] = self.parse(filename)
+                    break
+            else:
+                self.defs[name] = self.builtinDef(name, name)
+        return self.defs[name]
+
+    def builtinDef(self, builtin, name):
+        if builtin not in builtinChips:
+            raise hdlError("chip {} not found".format(builtin))
+        inputs, outputs = builtinPins[builtin]
+        return chipDef(name, inputs, outputs, builtin=builtin)
+
+#builtin combinational chips, built out of primitive gates on bit nets
+def _map(nl, kind, *buses):
+    return [nl.gate(kind, *bits) for bits in zip(*buses)]
+
+def _muxTree(nl, sel, inputs):
+    #select among 2**len(sel) buses, least significant select bit first
+    for s in sel:
+        inputs = [_map(nl, "mux", a, b, [s] * len(a)) for a, b in zip(inputs[0::2], inputs[1::2])]
+    return inputs[0]
+
+def _dmuxTree(nl, bit, sel):
+    outs = [bit]
+    for s in reversed(sel):
+        outs = [o for x in outs for o in (nl.gate("and", x, nl.gate("not", s)), nl.gate("and", x, s))]
+    return outs
+
+def _adder(nl, a, b, carry=netlist.FALSE):
+    out = []
+    for x, y in zip(a, b):
+        axb = nl.gate("xor", x, y)
+        out.append(nl.gate("xor", axb, carry))
+        carry = nl.gate("or", nl.gate("and", x, y), nl.gate("and", axb, carry))
+    return out, carry
+
+def _alu(nl, p):
+    x = [nl.gate("and", b, nl.gate("not", p["zx"][0])) for b in p["x"]]
+    x = _map(nl, "xor", x, p["nx"] * 16)
+    y = [nl.gate("and", b, nl.gate("not", p["zy"][0])) for b in p["y"]]
+    y = _map(nl, "xor", y, p["ny"] * 16)
+    out = _map(nl, "mux", _map(nl, "and", x, y), _adder(nl, x, y)[0], p["f"] * 16)
+    out = _map(nl, "xor", out, p["no"] * 16)
+    anyBit = out[0]
+    for b in out[1:]:
+        anyBit = nl.gate("or", anyBit, b)
+    return {"out": out, "zr": [nl.gate("not", anyBit)], "ng": [out[15]]}
+
+def _halfAdder(nl, p):
+    return {"sum": [nl.gate("xor", p["a"][0], p["b"][0])], "carry": [nl.gate("and", p["a"][0], p["b"][0])]}
+
+def _fullAdder(nl, p):
+    out, carry = _adder(nl, p["a"], p["b"], p["c"][0])
+    return {"sum": out, "carry": [carry]}
+
+def _or8Way(nl, p):
+    out = p["in"][0]
+    for b in p["in"][1:]:
+        out = nl.gate("or", out, b)
+    return {"out": [out]}
+
+#builtin clocked chips, simulated on whole words
+class stateChip(object):
+    '''
+    Base of the builtin clocked chips: output() gives the current outputs
+    from the values of combInputs, tick() samples all inputs at the rising
+    edge and tock() commits the new state at the falling edge
+    '''
+    inputs, outputs, combInputs = (), (), ()
+
+    def __init__(self):
+        self.name = type(self).__name__
+        self.state = self.next = 0
+
+    def output(self):
+        return (self.state,)
+
+    def tick(self, *values):
+        pass
+
+    def tock(self):
+        self.state = self.next
+
+    def __getitem__(self, index):
+        return self.state
+
+    def __setitem__(self, index, value):
+        self.state = self.next = value & 0xFFFF
+
+class DFF(stateChip):
+    inputs, outputs = (("in", 1),), (("out", 1),)
+
+    def tick(self, value):
+        self.next = value
+
+    def __setitem__(self, index, value):
+        self.state = self.next = value & 1
+
+class Bit(stateChip):
+    inputs, outputs = (("in", 1), ("load", 1)), (("out", 1),)
+
+    def tick(self, value, load):
+        self.next = value if load else self.state
+
+    def __setitem__(self, index, value):
+        self.state = self.next = value & 1
+
+class Register(stateChip):
+    inputs, outputs = (("in", 16), ("load", 1)), (("out", 16),)
+
+    def tick(self, value, load):
+        self.next = value if load else self.state
+
+class PC(stateChip):
+    inputs, outputs = (("in", 16), ("load", 1), ("inc", 1), ("reset", 1)), (("out", 16),)
+
+    def tick(self, value, load, inc, reset):
+        if reset:
+            self.next = 0
+        elif load:
+            self.next = value
+        elif inc:
+            self.next = (self.state + 1) & 0xFFFF
+        else:
+            self.next = self.state
+
+class RAM(stateChip):
+    '''
+    Memory of 2**addressWidth words, read combinationally from address,
+    written at the end of a cycle in which load was set
+    '''
+    addressWidth = 3
+    outputs, combInputs = (("out", 16),), ("address",)
+
+    def __init__(self):
+        super(RAM, self).__init__()
+        self.inputs = (("in", 16), ("load", 1), ("address", self.addressWidth))
+        self.memory = array.array("H", [0]) * (1 << self.addressWidth)
+        self.pending = None
+
+    def output(self, address):
+        return (self.memory[address],)
+
+    def tick(self, value, load, address):
+        self.pending = (address, value) if load else None
+
+    def tock(self):
+        if self.pending:
+            self.memory[self.pending[0]] = self.pending[1]
+            self.pending = None
+
+    def __getitem__(self, index):
+        return self.memory[index]
+
+    def __setitem__(self, index, value):
+        self.memory[index] = value & 0xFFFF
+
+class RAM8(RAM):
+    addressWidth = 3
+
+class RAM64(RAM):
+    addressWidth = 6
+
+class RAM512(RAM):
+    addressWidth = 9
+
+class RAM4K(RAM):
+    addressWidth = 12
+
+class RAM16K(RAM):
+    addressWidth = 14
+
+class Screen(RAM):
+    addressWidth = 13
+
+class ROM32K(RAM):
+    '''
+    Instruction memory, filled by "ROM32K load <file>.hack" in test scripts
+    '''
+    addressWidth = 15
+
+    def __init__(self):
+        super(ROM32K, self).__init__()
+        self.inputs = (("address", 15),)
+
+    def tick(self, address):
+        pass
+
+    def load(self, filename):
+        self.memory = array.array("H", [0]) * (1 << self.addressWidth)
+        with open(filename, "r") as inf:
+            for i, row in enumerate(row for row in inf if row.strip()):
+                self.memory[i] = int(row.strip(), 2)
+
+class Keyboard(stateChip):
+    outputs = (("out", 16),)
+
+#every builtin chip, combinational ones map to a function building gates
+#from {input pin: nets} and returning {output pin: nets}
+builtinChips = {
+    "Nand": lambda nl, p: {"out": [nl.gate("nand", p["a"][0], p["b"][0])]},
+    "Not": lambda nl, p: {"out": [nl.gate("not", p["in"][0])]},
+    "And": lambda nl, p: {"out": [nl.gate("and", p["a"][0], p["b"][0])]},
+    "Or": lambda nl, p: {"out": [nl.gate("or", p["a"][0], p["b"][0])]},
+    "Xor": lambda nl, p: {"out": [nl.gate("xor", p["a"][0], p["b"][0])]},
+    "Mux": lambda nl, p: {"out": [nl.gate("mux", p["a"][0], p["b"][0], p["sel"][0])]},
+    "DMux": lambda nl, p: dict(zip("ab", [[o] for o in _dmuxTree(nl, p["in"][0], p["sel"])])),
+    "Not16": lambda nl, p: {"out": _map(nl, "not", p["in"])},
+    "And16": lambda nl, p: {"out": _map(nl, "and", p["a"], p["b"])},
+    "Or16": lambda nl, p: {"out": _map(nl, "or", p["a"], p["b"])},
+    "Mux16": lambda nl, p: {"out": _map(nl, "mux", p["a"], p["b"], p["sel"] * 16)},
+    "Or8Way": _or8Way,
+    "Mux4Way16": lambda nl, p: {"out": _muxTree(nl, p["sel"], [p[c] for c in "abcd"])},
+    "Mux8Way16": lambda nl, p: {"out": _muxTree(nl, p["sel"], [p[c] for c in "abcdefgh"])},
+    "DMux4Way": lambda nl, p: dict(zip("abcd", [[o] for o in _dmuxTree(nl, p["in"][0], p["sel"])])),
+    "DMux8Way": lambda nl, p: dict(zip("abcdefgh", [[o] for o in _dmuxTree(nl, p["in"][0], p["sel"])])),
+    "HalfAdder": _halfAdder,
+    "FullAdder": _fullAdder,
+    "Add16": lambda nl, p: {"out": _adder(nl, p["a"], p["b"])[0]},
+    "Inc16": lambda nl, p: {"out": _adder(nl, p["in"], [netlist.FALSE] * 16, netlist.TRUE)[0]},
+    "ALU": _alu,
+    "DFF": DFF,
+    "Bit": Bit,
+    "Register": Register,
+    "ARegister": Register,
+    "DRegister": Register,
+    "PC": PC,
+    "RAM8": RAM8,
+    "RAM64": RAM64,
+    "RAM512": RAM512,
+    "RAM4K": RAM4K,
+    "RAM16K": RAM16K,
+    "Screen": Screen,
+    "Keyboard": Keyboard,
+    "ROM32K": ROM32K}
+
+def _pins(spec):
+    return [(pin, int(width)) for pin, width in (p.split(":") for p in spec.split())]
+
+#(inputs, outputs) of the builtin chips
+builtinPins = {
+    "Nand": (_pins("a:1 b:1"), _pins("out:1")),
+    "Not": (_pins("in:1"), _pins("out:1")),
+    "And": (_pins("a:1 b:1"), _pins("out:1")),
+    "Or": (_pins("a:1 b:1"), _pins("out:1")),
+    "Xor": (_pins("a:1 b:1"), _pins("out:1")),
+    "Mux": (_pins("a:1 b:1 sel:1"), _pins("out:1")),
+    "DMux": (_pins("in:1 sel:1"), _pins("a:1 b:1")),
+    "Not16": (_pins("in:16"), _pins("out:16")),
+    "And16": (_pins("a:16 b:16"), _pins("out:16")),
+    "Or16": (_pins("a:16 b:16"), _pins("out:16")),
+    "Mux16": (_pins("a:16 b:16 sel:1"), _pins("out:16")),
+    "Or8Way": (_pins("in:8"), _pins("out:1")),
+    "Mux4Way16": (_pins("a:16 b:16 c:16 d:16 sel:2"), _pins("out:16")),
+    "Mux8Way16": (_pins("a:16 b:16 c:16 d:16 e:16 f:16 g:16 h:16 sel:3"), _pins("out:16")),
+    "DMux4Way": (_pins("in:1 sel:2"), _pins("a:1 b:1 c:1 d:1")),
+    "DMux8Way": (_pins("in:1 sel:3"), _pins("a:1 b:1 c:1 d:1 e:1 f:1 g:1 h:1")),
+    "HalfAdder": (_pins("a:1 b:1"), _pins("sum:1 carry:1")),
+    "FullAdder": (_pins("a:1 b:1 c:1"), _pins("sum:1 carry:1")),
+    "Add16": (_pins("a:16 b:16"), _pins("out:16")),
+    "Inc16": (_pins("in:16"), _pins("out:16")),
+    "ALU": (_pins("x:16 y:16 zx:1 nx:1 zy:1 ny:1 f:1 no:1"), _pins("out:16 zr:1 ng:1"))}
+for _name, _builtin in builtinChips.items():
+    if isinstance(_builtin, type):
+        _node = _builtin()
+        builtinPins[_name] = (list(_node.inputs), list(_node.outputs))
+
+#tokens of a test script: strings, block braces, command separators and words
+scriptToken = re.compile(r'(?P<skip>\s+|//[^\n]*|/\*.*?\*/)|(?P<token>"[^"]*"|[{},;!]|[^\s{},;!]+)', re.DOTALL)
+#one column of an output-list, such as in%B3.1.3 or RAM16K[0]%D1.7.1
+outputSpec = re.compile(r"^([A-Za-z_]\w*)(?:\[(\d*)\])?%([BDXS])(\d+)\.(\d+)\.(\d+)$")
+
+class testScript(object):
+    '''
+    testScript runs a .tst script against its chip, writing the output file
+    and checking every output line against the compare file
+    '''
+    def __init__(self, tstName):
+        self.tstName = tstName
+        self.directory = os.path.dirname(os.path.abspath(tstName))
+        with open(tstName, "r") as inf:
+            tokens = [m.group() for m in scriptToken.finditer(inf.read()) if m.lastgroup == "token"]
+        self.commands, _ = self.parse(tokens, 0)
+        self.chip = None
+        self.columns = []
+        self.outf = None
+        self.compareLines = None
+        #number of lines written to the output file
+        self.lineCount = 0
+
+    def parse(self, tokens, pos):
+        '''
+        Group tokens into commands, each a (words, body) pair where body is
+        the list of commands of a repeat/while block, None otherwise
+        '''
+        commands, words = [], []
+        while pos < len(tokens):
+            token = tokens[pos]
+            pos += 1
+            if token in (",", ";", "!"):
+                if words:
+                    commands.append((words, None))
+                words = []
+            elif token == "{":
+                body, pos = self.parse(tokens, pos)
+                commands.append((words, body))
+                words = []
+            elif token == "}":
+                if words:
+                    commands.append((words, None))
+                return commands, pos
+            else:
+                words.append(token)
+        if words:
+            commands.append((words, None))
+        return commands, pos
+
+    def run(self):
+        try:
+            self.execute(self.commands)
+        finally:
+            if self.outf:
+                self.outf.close()
+
+    def execute(self, commands):
+        for words, body in commands:
+            name = words[0]
+            if body is not None:
+                if name == "repeat":
+                    if len(words) > 1:
+                        for i in range(int(words[1])):
+                            self.execute(body)
+                    else:
+                        while True:
+                            self.execute(body)
+                elif name == "while":
+                    while self.condition(words[1:]):
+                        self.execute(body)
+                else:
+                    raise hdlError("unknown block command {}".format(name))
+            elif name == "load":
+                self.chip = chip(os.path.join(self.directory, words[1]))
+            elif name == "output-file":
+                self.outf = open(os.path.join(self.directory, words[1]), "w")
+            elif name == "compare-to":
+                with open(os.path.join(self.directory, words[1]), "r") as inf:
+                    self.compareLines = [row.rstrip("\r\n") for row in inf]
+            elif name == "output-list":
+                self.columns = [self.parseColumn(word) for word in words[1:]]
+                self.writeLine("|" + "|".join(self.header(c) for c in self.columns) + "|")
+            elif name == "set":
+                self.setValue(words[1], self.parseValue(words[2]))
+            elif name == "eval":
+                self.chip.eval()
+            elif name == "tick":
+                self.chip.tick()
+            elif name == "tock":
+                self.chip.tock()
+            elif name == "output":
+                self.writeLine("|" + "|".join(self.cell(c) for c in self.columns) + "|")
+            elif name in ("echo", "clear-echo", "breakpoint", "clear-breakpoints"):
+                pass
+            elif len(words) == 3 and words[1] == "load":
+                #ROM32K load <file>.hack
+                self.chip.nodesByName[name].load(os.path.join(self.directory, words[2]))
+            else:
+                raise hdlError("unknown script command {}".format(" ".join(words)))
+
+    def parseColumn(self, word):
+        match = outputSpec.match(word)
+        if not match:
+            raise hdlError("bad output-list entry {}".format(word))
+        name, index, fmt, lpad, width, rpad = match.groups()
+        return (name, index, fmt, int(lpad), int(width), int(rpad))
+
+    def parseValue(self, word):
+        if word.startswith("%B"):
+            return int(word[2:], 2)
+        if word.startswith("%X"):
+            return int(word[2:], 16)
+        if word.startswith("%D"):
+            word = word[2:]
+        return int(word)
+
+    def getValue(self, name, index):
+        if name == "time":
+            return self.chip.timeString(), 0
+        if name in self.chip.pins:
+            value = self.chip.get(name)
+            width = len(self.chip.pins[name])
+            if index:
+                return value >> int(index) & 1, 1
+            return value, width
+        if name in self.chip.nodesByName:
+            node = self.chip.nodesByName[name]
+            return node[int(index) if index else 0], 16
+        raise hdlError("unknown pin {}".format(name))
+
+    def setValue(self, target, value):
+        match = re.match(r"^([A-Za-z_]\w*)(?:\[(\d*)\])?$", target)
+        name, index = match.groups()
+        if name in self.chip.inputs:
+            self.chip.set(name, value & ((1 << self.chip.inputs[name]) - 1))
+        elif name in self.chip.nodesByName:
+            self.chip.nodesByName[name][int(index) if index else 0] = value
+        else:
+            raise hdlError("cannot set {}".format(target))
+
+    def condition(self, words):
+        left, op, right = words
+        value, width = self.getValue(left, None)
+        if width == 16 and value & 0x8000:
+            value -= 0x10000
+        right = self.parseValue(right)
+        return {"=": value == right, "<>": value != right, "<": value < right,
+                ">": value > right, "<=": value <= right, ">=": value >= right}[op]
+
+    def header(self, column):
+        name, index, fmt, lpad, width, rpad = column
+        total = lpad + width + rpad
+        label = (name + ("[{}]".format(index) if index is not None else ""))[:total]
+        left = (total - len(label)) // 2
+        return " " * left + label + " " * (total - len(label) - left)
+
+    def cell(self, column):
+        name, index, fmt, lpad, width, rpad = column
+        value, bits = self.getValue(name, index)
+        if fmt == "S":
+            text = str(value).ljust(width)
+        elif fmt == "B":
+            text = format(value & ((1 << width) - 1), "0{}b".format(width))
+        elif fmt == "X":
+            text = format(value, "0{}X".format(width))
+        else:
+            if bits == 16 and value & 0x8000:
+                value -= 0x10000
+            text = str(value).rjust(width)
+        return " " * lpad + text[-width:] + " " * rpad
+
+    def writeLine(self, line):
+        if self.outf:
+            self.outf.write(line + "\n")
+        if self.compareLines is not None:
+            expected = self.compareLines[self.lineCount] if self.lineCount < len(self.compareLines) else None
+            if expected is None or not self.matches(line, expected):
+                raise hdlError("Comparison failure at line {}: expected {} but got {}".format(self.lineCount + 1, expected, line))
+        self.lineCount += 1
+
+    def matches(self, line, expected):
+        #"*" in the compare file matches any character
+        line, expected = line.replace(" ", ""), expected.replace(" ", "")
+        return len(line) == len(expected) and all(e == "*" or e == c for c, e in zip(line, expected))
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="HDL chip simulator")
+    argParser.add_argument("tstName", help="path of the .tst script to run")
+    args = argParser.parse_args()
+    script = testScript(args.tstName)
+    try:
+        script.run()
+    except hdlError as e:
+        print(e)
+        sys.exit(1)
+    if script.compareLines is not None:
+        print("End of script - Comparison ended successfully")
+    else:
+        print("End of script")
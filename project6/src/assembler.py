@@ -1,15 +1,35 @@
+import argparse
+import array
+import hashlib
+import itertools
+import mmap
+import multiprocessing
+import os
+import pickle
+import re
 import sys
 
 class textClean(object):
-    def __init__(self):
-        self.output = []
+    '''
+    textClean strips white spaces, "//" comments and "/* */" comments from
+    assembly text in a single regex-driven pass and yields one instruction
+    at a time, so the whole file never has to be held in memory
+    '''
+    #one alternative per thing to drop, block comments are matched lazily and
+    #an unterminated "/*" is captured separately so it can be carried over
+    #into the next chunk
+    scanner = re.compile(r"(?P<space>[ \t\r\f\v]+)|(?P<line>//[^\n]*)|"
+                         r"(?P<block>/\*.*?\*/)|(?P<open>/\*.*)", re.DOTALL)
+
+    def __init__(self, chunkSize=1 << 16):
+        #number of characters read from the input file at a time
+        self.chunkSize = chunkSize
 
     def textClean(self, inname):
         '''
         Function to execute text cleaning
-        Input: str, name of file for text cleaning, "<filename>.in"
-        The function will create an output file named "<filename>.out"
-        in the directory where <filename>.in resides
+        Input: str, name of file for text cleaning
+        Output: generator of cleaned instructions, one per line
         '''
         #reference https://stackoverflow.com/questions/713794/catching-an-exception-while-using-a-python-with-statement
         try:
@@ -17,95 +37,99 @@ class textClean(object):
         except:
             print("File not found or path is incorrect")
         else:
-            skipflag = False
-
             with inf:
-                for row in inf:
-                    clean = self.stripSpacesTabs(row)
-                    clean = self.stripSingleLineComments(clean)
-
-                    if not clean:
-                        continue
-
-                    if self.isBlockCommentsStart(clean):
-                        #In case multi-line comments start mid-line, keep what's before
-                        clean = self.removeStartingComments(clean)
-                        if clean:
-                            self.output.append(clean)
-                        skipflag = True
-
-                    if not skipflag:
-                        self.output.append(clean)
-
-                    if self.isBlockCommentsEnd(row):
-                        #In case multi-line comments end mid-line, keep what's after
-                        clean = self.removeClosingComments(clean)
-                        if clean:
-                            self.output.append(clean)
-                        skipflag = False
+                chunks = iter(lambda: inf.read(self.chunkSize), "")
+                for syntax in self.clean(chunks):
+                    yield syntax
 
-        return self.output
-
-    def stripSpacesTabs(self, s):
+    def clean(self, chunks):
         '''
-        Function to remove all white spaces, tab and line returns(to be added
-        back again at the end) in a row of string
-        Input: str containing white spaces
-        Output: str after removing white spaces
+        Clean an iterable of text chunks, the chunks do not need to end on
+        line boundaries
+        Output: generator of cleaned instructions, one per line
         '''
-        for ch in (" ", "\t", "\n", "\r"):
-            s = s.replace(ch, "")
-        return s
+        carry = ""
+        #inside a block comment left open by an earlier chunk, and the last
+        #character read of it, which a "/" at the start of a chunk may close
+        inBlock, tail = False, ""
+        chunks = iter(chunks)
+        while True:
+            chunk = next(chunks, None)
+            if inBlock:
+                #only the text read since the comment was left open is
+                #searched for its end, what comes before the end is dropped
+                text = tail + carry + (chunk or "")
+                end = text.find("*/")
+                if end < 0:
+                    if chunk is None:
+                        #the comment runs to the end of input
+                        return
+                    tail, carry = text[-1:], ""
+                    continue
+                inBlock = False
+                buf = "\n" + text[end + 2:]
+            else:
+                buf = carry + (chunk or "")
+            if chunk is None:
+                #end of input, whatever is left is the last line
+                head, carry = buf, ""
+            else:
+                #only clean up to the last complete line, keep the rest
+                cut = buf.rfind("\n") + 1
+                head, carry = buf[:cut], buf[cut:]
+                if not head:
+                    continue
 
-    def stripSingleLineComments(self, s):
-        '''
-        Function to remove a single line of comments starting with //
-        Input: str containing comments
-        Output: str after removing comments
-        '''
-        for i in range(len(s)-1):
-            if s[i:i+2] == "//":
-                return s[:i]
-        return s
+            pending = []
+            clean = self.scanner.sub(lambda m: self.drop(m, pending), head)
+            if pending and chunk is not None:
+                #block comment still open, the partial line after it is
+                #searched for its end together with the next chunk
+                inBlock, tail = True, pending[0][2:][-1:]
 
-    def isBlockCommentsStart(self, s):
-        '''
-        Input: str to examine
-        Output: Bool, true if /* is in the str otherwise false
-        '''
-        return True if "/*" in s else False
+            for syntax in clean.split("\n"):
+                if syntax:
+                    yield syntax
 
-    def removeStartingComments(self, s):
-        '''
-        Removing comments with leading "/*" from a line
-        Input: str containing comments
-        Output: str after removing start of multi-lines comments
-        '''
-        for i in range(len(s)-1):
-            if s[i:i+2] == "/*":
-                return s[:i]
+            if chunk is None:
+                return
 
-    def isBlockCommentsEnd(self, s):
+    def drop(self, match, pending):
         '''
-        Input: str to examine
-        Output: Bool, true if */ is in the str otherwise false
+        Replacement for every scanner match, block comments become a line
+        return so that text on either side of them stays on separate lines
         '''
-        return self.isBlockCommentsStart(s[::-1])
+        kind = match.lastgroup
+        if kind == "block":
+            return "\n"
+        if kind == "open":
+            pending.append(match.group())
+        return ""
 
-    def removeClosingComments(self, s):
-        '''
-        Removing comments with closing "*/" from a line
-        Input: str containing comments
-        Ouput: str after striping
-        '''
-        for i in range(1, len(s)):
-            if s[i-1:i+1] == "*/":
-                return s[i+1:]
+#programs shorter than this are encoded serially whatever jobs is: starting
+#the pool and collecting the words costs about 0.1s plus 0.1us a line, which
+#only pays off against the 0.45us a line of encoding from about 400K lines
+#up with 4 processes
+PARALLEL_MIN_LINES = 500000
+
+#bumped whenever the layout of the incremental cache changes
+CACHE_VERSION = 2
 
 class assembler(object):
-    def __init__(self, input):
+    def __init__(self, input, jobs=1, cacheName=None, sourceKey=None):
         #clean syntax after processed by textClean
         self.input = input
+        #number of processes used to encode instructions in secondPass, for
+        #programs of at least PARALLEL_MIN_LINES instructions
+        self.jobs = jobs
+        #sidecar file caching the result of the previous run, when set and
+        #the source still has the content hash sourceKey the previous run
+        #saved, firstPass takes the program from the cache and neither input
+        #is read nor secondPass encodes anything
+        self.cacheName = cacheName
+        self.sourceKey = sourceKey
+        #set once firstPass took the program from the cache
+        self.cached = False
         #contain resulting syntax of firstPass processing
         self.firstPassOutput = []
         #machine language translated by assembler
@@ -136,6 +160,8 @@ class assembler(object):
                             "KBD": 24576}
         #addresses for symbol assignments, starting from 16
         self.ramAdd = 16
+        #labels found by firstPass and the rom addresses they mark
+        self.labels = {}
         #compTable mapping comp part in C instruction to its corresponding
         #binary bits from c1-c6
         self.compTable = {"0": "101010",
@@ -165,7 +191,14 @@ class assembler(object):
                           "D&A": "000000",
                           "D&M": "000000",
                           "D|A": "010101",
-                          "D|M": "010101"}
+                          "D|M": "010101",
+                          #commuted spellings of the symmetric operations
+                          "A+D": "000010",
+                          "M+D": "000010",
+                          "A&D": "000000",
+                          "M&D": "000000",
+                          "A|D": "010101",
+                          "M|D": "010101"}
         #destTable mapping dest part in C instruction to its corresponding
         #binary bits from d1-d3
         self.destTable = {"M": "001",
@@ -184,6 +217,31 @@ class assembler(object):
                           "JNE": "101",
                           "JLE": "110",
                           "JMP": "111"}
+        #cTable mapping every valid C instruction, for all orderings of its
+        #dest part, straight to its 16-bit machine word
+        self.cTable = self.buildCTable()
+
+    def buildCTable(self):
+        '''
+        Precompute the machine word of every comp/dest/jump combination so
+        that a C instruction is translated with a single dict lookup
+        '''
+        dests = {"": 0}
+        for dest, bits in self.destTable.items():
+            for perm in itertools.permutations(dest):
+                dests["".join(perm) + "="] = int(bits, 2) << 3
+        jumps = {"": 0}
+        for jump, bits in self.jumpTable.items():
+            jumps[";" + jump] = int(bits, 2)
+
+        table = {}
+        for comp, bits in self.compTable.items():
+            #bit a should be 1 when M is in comp otherwise 0
+            word = 0b111 << 13 | ("M" in comp) << 12 | int(bits, 2) << 6
+            for dest, destWord in dests.items():
+                for jump, jumpWord in jumps.items():
+                    table[dest + comp + jump] = word | destWord | jumpWord
+        return table
 
     def firstPass(self):
         '''
@@ -191,12 +249,14 @@ class assembler(object):
         adding syntaxes after taking out labels to self.firstPassOutput
         and assign labels to line numbers at the meantime
         '''
+        if self.cacheName and self.loadCache():
+            return
         for syntax in self.input:
             #striping parenthesis wrap of labels, assign address to symbol
             if syntax[0] == "(":
                 for ch in ("(", ")"):
                     syntax = syntax.replace(ch, "")
-                self.symbolTable[syntax] = len(self.firstPassOutput)
+                self.symbolTable[syntax] = self.labels[syntax] = len(self.firstPassOutput)
             else:
                 self.firstPassOutput.append(syntax)
 
@@ -204,6 +264,21 @@ class assembler(object):
         '''
         Second pass, translate assembly language to machine language
         '''
+        if self.cached:
+            return
+        self.allocateVariables()
+        if self.jobs > 1 and len(self.firstPassOutput) >= PARALLEL_MIN_LINES:
+            self.output.extend(self.encodeParallel())
+        else:
+            self.output.extend([self.asmToMl(syntax) for syntax in self.firstPassOutput])
+        if self.cacheName:
+            self.saveCache()
+
+    def allocateVariables(self):
+        '''
+        Assign RAM addresses to variable symbols in the order they first
+        appear, after this every symbol of the program is in symbolTable
+        '''
         for syntax in self.firstPassOutput:
             #case @counter, assign address to symbol "counter",
             #increment self.ramAdd by 1
@@ -213,59 +288,187 @@ class assembler(object):
                     self.symbolTable[symbol] = self.ramAdd
                     self.ramAdd += 1
 
-            self.output.append(self.asmToMl(syntax))
+    def loadCache(self):
+        '''
+        Take the cleaned lines, the symbol table and the machine words of the
+        program from the sidecar cache when it was saved for the same source
+        Output: True when the cache was used, a missing, unreadable or stale
+        cache is not
+        '''
+        try:
+            with open(self.cacheName, "rb") as inf:
+                cache = pickle.load(inf)
+        except Exception:
+            return False
+        if cache.get("version") != CACHE_VERSION or self.sourceKey is None or \
+           cache.get("source") != self.sourceKey:
+            return False
+        self.firstPassOutput = cache["lines"].split("\n") if cache["lines"] else []
+        self.symbolTable = cache["symbolTable"]
+        self.labels = cache["labels"]
+        words = array.array("L")
+        words.frombytes(cache["words"])
+        self.output = words.tolist()
+        self.cached = True
+        return True
+
+    def saveCache(self):
+        '''
+        Save the cleaned lines, the symbol table and the machine words of this
+        run to the sidecar cache, under the content hash of the source
+        '''
+        cache = {"version": CACHE_VERSION,
+                 "source": self.sourceKey,
+                 #one string and one buffer load much faster than a list each
+                 "lines": "\n".join(self.firstPassOutput),
+                 "symbolTable": self.symbolTable,
+                 "labels": self.labels,
+                 "words": array.array("L", self.output).tobytes()}
+        #write next to the cache and rename, a crash never leaves half a cache
+        tmpname = self.cacheName + ".tmp"
+        with open(tmpname, "wb") as outf:
+            pickle.dump(cache, outf, 2)
+        os.replace(tmpname, self.cacheName)
+
+    def encodeParallel(self):
+        '''
+        Encode self.firstPassOutput in chunks across a pool of self.jobs
+        processes, chunks are combined back in program order; the workers
+        are handed the lines and the symbol table once, when they start,
+        every task is only a range of lines and every result the packed
+        words of that range; secondPass only calls it for programs of at
+        least PARALLEL_MIN_LINES instructions
+        '''
+        #a few chunks per process so that a slow chunk does not hold up the rest
+        size = max(1, -(-len(self.firstPassOutput) // (self.jobs * 4)))
+        ranges = [(i, i + size) for i in range(0, len(self.firstPassOutput), size)]
+
+        output = array.array("L")
+        pool = multiprocessing.Pool(self.jobs, _initWorker, (self.firstPassOutput, self.symbolTable))
+        try:
+            for words in pool.imap(_encodeRange, ranges):
+                output.frombytes(words)
+        finally:
+            pool.close()
+            pool.join()
+        return output.tolist()
 
     def asmToMl(self, syntax):
         '''
-        Translate every assembly syntax into machine language syntax
+        Translate every assembly syntax into its 16-bit machine word
         '''
         #case A instruction
         if syntax[0] == "@":
             value = syntax[1:]
             #if value after @ is not numeric but a symbol, look up in symbolTable
             if not value[0].isdigit():
-                value = self.symbolTable[value]
-            return "{0:016b}".format(int(value))
+                return self.symbolTable[value]
+            return int(value)
         #case C instruction
-        else:
-            bi_a, bi_c1Toc6, bi_d1Tod3, bi_j1Toj3 = "0", "0" * 6, "0" * 3, "0" * 3
-            comp = syntax
-            dest = jump = None
-            #case when dest exists, slice comp into dest and comp
-            if "=" in comp:
-                i = comp.index("=")
-                comp, dest = comp[i+1:], comp[:i]
-            #case when jump exists, slice comp into comp and jump
-            if ";" in comp:
-                j = comp.index(";")
-                comp, jump = comp[:j], comp[j+1:]
-            #bit a should be 1 when M is in comp otherwise 0
-            if "M" in comp:
-                bi_a = "1"
-            #bit c1-c6
-            bi_c1Toc6 = self.compTable[comp]
-            #bit d1-d3
-            if dest:
-                bi_d1Tod3 = self.destTable["".join(sorted(dest))]
-            #bit j1-j3
-            if jump:
-                bi_j1Toj3 = self.jumpTable[jump]
-
-            return "111" + bi_a + bi_c1Toc6 + bi_d1Tod3 + bi_j1Toj3
+        return self.cTable[syntax]
 
     def toBinary(self, outname):
         self.firstPass()
         self.secondPass()
         outf = open(outname, "w")
         with outf:
-            for row in self.output:
-                row += "\n"
-                outf.write(row)
+            #machine words are only formatted as text at the final write
+            outf.write("".join(["{0:016b}\n".format(word) for word in self.output]))
+
+    def toPacked(self, outname, byteorder="little"):
+        '''
+        Same as toBinary, but write the program as packed uint16 words in
+        the given byte order, 2 bytes per instruction, in one bulk write
+        '''
+        self.firstPass()
+        self.secondPass()
+        #only an A instruction with a constant above 65535 can overflow a word
+        if self.output and max(self.output) > 0xFFFF:
+            i = next(i for i, word in enumerate(self.output) if word > 0xFFFF)
+            raise ValueError("instruction {} does not fit in 16 bits: {}".format(i, self.firstPassOutput[i]))
+        words = array.array("H", self.output)
+        if byteorder != sys.byteorder:
+            words.byteswap()
+        outf = open(outname, "wb")
+        with outf:
+            words.tofile(outf)
+
+#assembler owned by a worker process of encodeParallel, holding the lines
+#and the finished symbol table of the parent
+_worker = None
+
+def _initWorker(lines, symbolTable):
+    global _worker
+    _worker = assembler([])
+    _worker.firstPassOutput = lines
+    _worker.symbolTable = symbolTable
+
+def _encodeRange(lines):
+    start, stop = lines
+    asmToMl = _worker.asmToMl
+    return array.array("L", [asmToMl(syntax) for syntax in _worker.firstPassOutput[start:stop]]).tobytes()
+
+def sourceHash(inname):
+    '''
+    Content hash of the file inname and of the assembler itself, the key of
+    the incremental cache, a change to either assembles the program again
+    '''
+    digest = hashlib.sha1()
+    for name in (os.path.splitext(__file__)[0] + ".py", inname):
+        with open(name, "rb") as inf:
+            for chunk in iter(lambda: inf.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def readPacked(inname, byteorder="little"):
+    '''
+    Read a program written by assembler.toPacked, the file is memory-mapped
+    and its words are read in place through a view of the mapping, which
+    stays open as long as the view is in use; words in the other byte order
+    are copied into an array to be swapped, and viewed the same way
+    Output: memoryview of machine words
+    '''
+    with open(inname, "rb") as inf:
+        size = os.fstat(inf.fileno()).st_size
+        if size % 2:
+            raise ValueError("{}: {} bytes is not a whole number of 16-bit words".format(inname, size))
+        #mmap refuses to map an empty file
+        if not size:
+            return memoryview(array.array("H"))
+        mm = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+    if byteorder == sys.byteorder:
+        #the view holds on to the mapping, closing the file leaves it mapped
+        return memoryview(mm).cast("H")
+    try:
+        words = array.array("H", mm[:])
+    finally:
+        mm.close()
+    words.byteswap()
+    return memoryview(words)
 
 if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description="Hack assembler")
+    argParser.add_argument("inname", help="path of the .asm file to assemble")
+    argParser.add_argument("--packed", action="store_true",
+                           help="write packed uint16 words to <name>.bin")
+    argParser.add_argument("--byteorder", choices=("little", "big"),
+                           default="little", help="byte order of --packed output")
+    argParser.add_argument("--jobs", type=int, default=1,
+                           help="number of processes for the second pass, only used for "
+                                "programs of at least {} instructions".format(PARALLEL_MIN_LINES))
+    argParser.add_argument("--incremental", action="store_true",
+                           help="skip assembling an unchanged source, the result is kept "
+                                "in the <output>.cache sidecar file")
+    args = argParser.parse_args()
+
+    outname = os.path.splitext(args.inname)[0] + (".bin" if args.packed else ".hack")
     t = textClean()
-    inname = sys.argv[1]
-    outname = inname.split(".")[0] + ".hack"
-    text = t.textClean(inname)
-    a = assembler(text)
-    a.toBinary(outname)
+    text = t.textClean(args.inname)
+    if args.incremental:
+        a = assembler(text, args.jobs, outname + ".cache", sourceHash(args.inname))
+    else:
+        a = assembler(text, args.jobs)
+    if args.packed:
+        a.toPacked(outname, args.byteorder)
+    else:
+        a.toBinary(outname)
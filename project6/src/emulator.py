@@ -0,0 +1,347 @@
+import argparse
+import array
+import hashlib
+import re
+import sys
+import assembler
+
+#sizes of instruction memory and data memory, in 16-bit words
+ROM_SIZE = RAM_SIZE = 32768
+#base addresses of the memory maps for screen and keyboard
+SCREEN = 16384
+KBD = 24576
+
+#ALU output for the comp field (bits c1-c6) of every C instruction listed in
+#assembler.compTable, as a Python expression over x (D register) and y (A
+#register or M), masked to 16 bits
+compExpr = {0b101010: "0",
+            0b111111: "1",
+            0b111010: "65535",
+            0b001100: "x",
+            0b110000: "y",
+            0b001101: "x ^ 65535",
+            0b110001: "y ^ 65535",
+            0b001111: "-x & 65535",
+            0b110011: "-y & 65535",
+            0b011111: "(x + 1) & 65535",
+            0b110111: "(y + 1) & 65535",
+            0b001110: "(x - 1) & 65535",
+            0b110010: "(y - 1) & 65535",
+            0b000010: "(x + y) & 65535",
+            0b010011: "(x - y) & 65535",
+            0b000111: "(y - x) & 65535",
+            0b000000: "x & y",
+            0b010101: "x | y"}
+
+def aluExpr(comp):
+    '''
+    Python expression over x and y computing the ALU output for the 6 comp
+    bits zx nx zy ny f no, comp fields outside compExpr are built bit by bit
+    the way the ALU chip computes them
+    '''
+    if comp in compExpr:
+        return compExpr[comp]
+    zx, nx, zy, ny, f, no = [(comp >> (5 - i)) & 1 for i in range(6)]
+    x = "0" if zx else "x"
+    if nx:
+        x = "({} ^ 65535)".format(x)
+    y = "0" if zy else "y"
+    if ny:
+        y = "({} ^ 65535)".format(y)
+    out = "({} + {})".format(x, y) if f else "({} & {})".format(x, y)
+    if no:
+        out = "({} ^ 65535)".format(out)
+    return "{} & 65535".format(out)
+
+#condition on the ALU output o for every jump field (bits j1-j3)
+jumpExpr = {0b001: "0 < o < 32768",
+            0b010: "o == 0",
+            0b011: "o < 32768",
+            0b100: "o >= 32768",
+            0b101: "o != 0",
+            0b110: "o == 0 or o >= 32768",
+            0b111: "True"}
+
+#longest run of instructions compiled into one block
+MAX_BLOCK = 256
+
+#compiled blocks shared by every jitEmulator, keyed by a hash of the rom and
+#its block leaders, each entry maps an entry pc to (function, instructions);
+#entries are kept in the order their roms were last loaded and only the
+#BLOCK_CACHE_ROMS most recent ones are kept
+BLOCK_CACHE_ROMS = 4
+_blockCache = {}
+
+class emulator(object):
+    '''
+    emulator runs Hack machine language, as produced by the assembler,
+    ROM and RAM are kept in array("H") buffers and every instruction is
+    predecoded into a dispatch tuple when the program is loaded
+    '''
+    def __init__(self):
+        #instruction memory and data memory, SCREEN and KBD are mapped into ram
+        self.rom = array.array("H", [0]) * ROM_SIZE
+        self.ram = array.array("H", [0]) * RAM_SIZE
+        #predecoded program, one tuple per instruction in rom
+        self.code = []
+        #registers of the CPU
+        self.A = self.D = self.PC = 0
+        #number of instructions executed since the last reset
+        self.cycles = 0
+        #set once the program reaches its terminating infinite loop
+        self.halted = False
+        #ALU functions shared by all instructions with the same comp field
+        self.alu = {}
+
+    def load(self, words):
+        '''
+        Load a program into rom, words being machine words such as
+        assembler.output or the memoryview returned by assembler.readPacked
+        '''
+        #a memoryview from assembler.readPacked is copied in a single step
+        words = array.array("H", words.tobytes() if isinstance(words, memoryview) else words)
+        if len(words) > ROM_SIZE:
+            raise ValueError("program has {} instructions, ROM holds {}".format(len(words), ROM_SIZE))
+        self.rom = words + array.array("H", [0]) * (ROM_SIZE - len(words))
+        self.code = self.predecode(words)
+        self.reset()
+
+    def loadHack(self, inname):
+        '''
+        Load a .hack file written by assembler.toBinary
+        '''
+        with open(inname, "r") as inf:
+            self.load([int(row, 2) for row in inf if row.strip()])
+
+    def loadPacked(self, inname, byteorder="little"):
+        '''
+        Load a packed file written by assembler.toPacked
+        '''
+        self.load(assembler.readPacked(inname, byteorder))
+
+    def predecode(self, words):
+        '''
+        Decode every instruction once into a tuple of
+        (isC, value or ALU function, useM, writeA, writeD, writeM, jump, halt)
+        where halt marks the "@n, 0;JMP" loop a program ends with
+        '''
+        code = []
+        for pc, word in enumerate(words):
+            if not word & 0x8000:
+                code.append((False, word, False, False, False, False, 0, False))
+                continue
+            comp = (word >> 6) & 0b111111
+            if comp not in self.alu:
+                self.alu[comp] = eval("lambda x, y: " + aluExpr(comp))
+            jump = word & 0b111
+            halt = jump == 0b111 and not word & 0b111000 and pc > 0 and words[pc - 1] == pc - 1
+            code.append((True, self.alu[comp], bool(word & 0x1000), bool(word & 0b100000),
+                         bool(word & 0b10000), bool(word & 0b1000), jump, halt))
+        #the rest of rom is zeros, padding it keeps a bounds check out of run
+        code.extend([(False, 0, False, False, False, False, 0, False)] * (ROM_SIZE - len(code)))
+        return code
+
+    def reset(self):
+        '''
+        Restart the program, ram is left untouched as on the real machine
+        '''
+        self.A = self.D = self.PC = 0
+        self.cycles = 0
+        self.halted = False
+
+    def setKey(self, key):
+        '''
+        Hold down a key, 0 for none
+        '''
+        self.ram[KBD] = key
+
+    def screen(self):
+        '''
+        Words of the screen memory map, 32 words per row of 512 pixels
+        '''
+        return self.ram[SCREEN:KBD]
+
+    def run(self, maxCycles=None):
+        '''
+        Execute instructions until the program halts or maxCycles have run
+        Output: number of instructions executed by this call
+        '''
+        code, ram = self.code, self.ram
+        A, D, pc = self.A, self.D, self.PC
+        n, limit = 0, maxCycles if maxCycles is not None else sys.maxsize
+        while n < limit:
+            n += 1
+            isC, comp, useM, writeA, writeD, writeM, jump, halt = code[pc]
+            if not isC:
+                A = comp
+                pc += 1
+                continue
+            out = comp(D, ram[A] if useM else A)
+            #jump bits j1 j2 j3 select on out < 0, out == 0 and out > 0
+            if jump & (2 if out == 0 else 4 if out & 0x8000 else 1):
+                if halt and A == pc - 1:
+                    self.halted = True
+                    break
+                #rom is addressed by the low 15 bits of pc
+                nextPC = A & 0x7FFF
+            else:
+                nextPC = pc + 1
+            if writeM:
+                ram[A] = out
+            if writeD:
+                D = out
+            if writeA:
+                A = out
+            pc = nextPC
+        self.A, self.D, self.PC = A, D, pc
+        self.cycles += n
+        return n
+
+class jitEmulator(emulator):
+    '''
+    jitEmulator runs the program one basic block at a time, every block is
+    turned into a specialized Python function holding A and D in locals the
+    first time execution enters it
+    '''
+    def __init__(self):
+        super(jitEmulator, self).__init__()
+        #rom addresses that start a block, such as the labels of the program
+        self.leaders = frozenset()
+        #compiled blocks of the loaded program, shared through _blockCache
+        self.blocks = {}
+
+    def load(self, words, labels=()):
+        '''
+        Load a program into rom, labels being the rom addresses jumps go to,
+        for instance assembler.labels.values(), blocks are split there
+        '''
+        super(jitEmulator, self).load(words)
+        self.leaders = frozenset(labels)
+        digest = hashlib.sha1(self.rom)
+        digest.update(repr(sorted(self.leaders)).encode())
+        key = digest.hexdigest()
+        blocks = _blockCache.pop(key, None)
+        self.blocks = _blockCache[key] = blocks if blocks is not None else {}
+        while len(_blockCache) > BLOCK_CACHE_ROMS:
+            #drop the rom loaded least recently
+            del _blockCache[next(iter(_blockCache))]
+
+    def compileBlock(self, start):
+        '''
+        Generate and compile the block entered at start, the block runs on
+        past conditional jumps until an unconditional jump, the next leader
+        or MAX_BLOCK instructions; a jump back to start whose target is a
+        constant loops inside the function while budget allows
+        Output: (function(ram, A, D, budget) returning (pc, A, D, executed),
+        instructions on the longest path through the block)
+        '''
+        body = []
+        pc = start
+        #value of A when it is known at compile time, None otherwise
+        constA = None
+        while True:
+            word = self.rom[pc]
+            count = pc - start + 1
+            if not word & 0x8000:
+                body.append("A = {}".format(word))
+                constA = word
+            else:
+                useM, writeA, writeD, writeM = word & 0x1000, word & 0b100000, word & 0b10000, word & 0b1000
+                jump = word & 0b111
+                expr = re.sub(r"\bx\b", "D", aluExpr((word >> 6) & 0b111111))
+                expr = re.sub(r"\by\b", "ram[A]" if useM else "A", expr)
+                body.append("o = " + expr)
+                target = "A" if constA is None else str(constA)
+                if jump and writeA and constA is None:
+                    #the jump goes to the value A had before this instruction
+                    body.append("t = A")
+                    target = "t"
+                if writeM:
+                    body.append("ram[A] = o")
+                if writeD:
+                    body.append("D = o")
+                if writeA:
+                    body.append("A = o")
+                    constA = None
+                if jump:
+                    cond = jumpExpr[jump]
+                    if self.code[pc][7]:
+                        #closing "@n, 0;JMP" loop, ~pc tells run the program halted
+                        target = "{0} & 32767 if {0} != {1} else {2}".format(target, pc - 1, ~pc)
+                    elif target == str(start):
+                        #jump back to the top of the block, loop in place as
+                        #long as another full pass fits in the budget
+                        body.append("if {}:".format(cond))
+                        body.append("    n += {}".format(count))
+                        body.append("    if n + LENGTH <= budget:")
+                        body.append("        continue")
+                        body.append("    return {}, A, D, n".format(start))
+                        target = None
+                    else:
+                        target += " & 32767"
+                    if target is not None:
+                        body.append("if {}:".format(cond))
+                        body.append("    return {}, A, D, n + {}".format(target, count))
+                    if jump == 0b111:
+                        break
+            pc += 1
+            if pc in self.leaders or pc - start >= MAX_BLOCK or pc >= ROM_SIZE:
+                body.append("return {}, A, D, n + {}".format(pc, count))
+                break
+
+        lines = ["def block(ram, A, D, budget):",
+                 "    n = 0",
+                 "    while True:"]
+        lines.extend(["        " + line.replace("LENGTH", str(count)) for line in body])
+        namespace = {}
+        exec(compile("\n".join(lines), "<block {}>".format(start), "exec"), namespace)
+        self.blocks[start] = (namespace["block"], count)
+        return self.blocks[start]
+
+    def run(self, maxCycles=None):
+        '''
+        Execute blocks until the program halts or maxCycles have run, the
+        last few instructions before the limit are left to emulator.run
+        Output: number of instructions executed by this call
+        '''
+        blocks, ram = self.blocks, self.ram
+        A, D, pc = self.A, self.D, self.PC
+        n, limit = 0, maxCycles if maxCycles is not None else sys.maxsize
+        while True:
+            block = blocks.get(pc) or self.compileBlock(pc)
+            if n + block[1] > limit:
+                break
+            pc, A, D, executed = block[0](ram, A, D, limit - n)
+            n += executed
+            if pc < 0:
+                self.A, self.D, self.PC = A, D, ~pc
+                self.halted = True
+                self.cycles += n
+                return n
+        self.A, self.D, self.PC = A, D, pc
+        self.cycles += n
+        return n + super(jitEmulator, self).run(limit - n)
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="Hack machine emulator")
+    argParser.add_argument("inname", help=".hack file, or .bin file written with --packed")
+    argParser.add_argument("--byteorder", choices=("little", "big"),
+                           default="little", help="byte order of a .bin file")
+    argParser.add_argument("--cycles", type=int, default=None,
+                           help="stop after this many instructions")
+    argParser.add_argument("--jit", action="store_true",
+                           help="compile basic blocks instead of interpreting")
+    argParser.add_argument("--ram", default="0:16",
+                           help="range of ram words to print when done, as start:end")
+    args = argParser.parse_args()
+
+    e = jitEmulator() if args.jit else emulator()
+    if args.inname.endswith(".bin"):
+        e.loadPacked(args.inname, args.byteorder)
+    else:
+        e.loadHack(args.inname)
+    e.run(args.cycles)
+    start, end = [int(i) for i in args.ram.split(":")]
+    print("cycles: {}{}".format(e.cycles, "" if e.halted else " (not halted)"))
+    for address in range(start, end):
+        print("RAM[{}] = {}".format(address, e.ram[address]))
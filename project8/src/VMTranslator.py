@@ -1,90 +1,123 @@
+import argparse
 import sys
 import collections
 import glob
+import io
+import multiprocessing
 import os
+import peepholeOptimizer
+
+#opcodes of the vm commands
+ARITHMETIC, PUSH, POP, BRANCHING, CALL, FUNCTION, RETURN, BOOTSTRAP = range(8)
+
+#a single parsed vm command, immutable and shared freely between stages
+#op: opcode above, commandType: its name as used by codeWriter
+#argOne, argTwo: arguments as described in parser, "" when absent
+#functionName: function the command belongs to, raw: source line
+command = collections.namedtuple("command", "op commandType argOne argTwo functionName raw")
+
+def callGraph(functions):
+    #map the name of every function to the names of the functions it calls,
+    #functions being lists of commands each starting with its "function"
+    return dict((function[0].argOne, set(cmd.argOne for cmd in function if cmd.op == CALL)) \
+                for function in functions if function and function[0].op == FUNCTION)
+
+def reachableFunctions(calls, entry="Sys.init"):
+    #names of the functions reached from entry through the call graph calls
+    reached = set()
+    stack = [entry]
+    while stack:
+        name = stack.pop()
+        if name not in reached:
+            reached.add(name)
+            stack.extend(calls.get(name, ()))
+    return reached
 
 class parser(object):
     '''
-    parser class that parse a single line of vm command into individual parts
+    parser class that parse a single line of vm command into a command record
     including:
     commandType: if a command is arithmetic or push/pop
     argOne: first argument including "sub", "neg", "gt", "not",
     "add", "eq", "lt", "or", "and", "not", "push", "pop"
     argTwo: second argument, namely index into each memory segment, a command has
     second argument only when the command type is push/pop
+    each line is classified by a single lookup in parser.table
     '''
+    #first token -> (opcode, commandType, number of tokens, token index of
+    #argOne, token index of argTwo), index -1 picks the empty padding token
+    table = {}
+    for keyword in ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]:
+        table[keyword] = (ARITHMETIC, "arithmetic", 1, 0, -1)
+    for keyword in ["label", "goto", "if-goto"]:
+        table[keyword] = (BRANCHING, "branching", 2, 0, 1)
+    for op, keyword in [(PUSH, "push"), (POP, "pop"), (CALL, "call"), (FUNCTION, "function")]:
+        table[keyword] = (op, keyword, 3, 1, 2)
+    table["return"] = (RETURN, "return", 1, -1, -1)
+    table["bootstrap"] = (BOOTSTRAP, "bootstrap", 1, -1, -1)
+    del keyword, op
+
     def __init__(self):
-        #raw vm command
-        self.raw = ""
-        #split raw command into a list of tokens
-        self.tokens = []
-        self.commandType = ""
-        self.argOne = ""
-        self.argTwo = ""
+        #name of the function the commands being parsed belong to, set by
+        #each "function" command and carried by every command after it
         self.functionName = ""
 
-    def genCommandType(self):
-        #method to assign command type
-        if self.tokens[0] in {"sub", "neg", "gt", "not", "add", "eq", "lt", "or",\
-         "and", "not"}:
-            self.commandType = "arithmetic"
-        elif self.tokens[0] in {"push", "pop", "call", "function", "return", "bootstrap"}:
-            self.commandType = self.tokens[0]
-        elif self.tokens[0] in {"label", "goto", "if-goto"}:
-            self.commandType = "branching"
-
-    def genArgOne(self):
-        #method to assign argOne according to command types
-        if self.commandType in {"arithmetic", "branching"}:
-            self.argOne = self.tokens[0]
-        elif self.commandType in {"push", "pop", "call", "function"}:
-            self.argOne = self.tokens[1]
-
-    def genArgTwo(self):
-        #method to assign argTwo, only applicable when command type is push/pop and branching
-        if self.commandType in {"push", "pop", "call", "function"}:
-            self.argTwo = self.tokens[2]
-        elif self.commandType == "branching":
-            self.argTwo = self.tokens[1]
-
-    def genFunctionName(self):
-        if self.commandType == "function":
-            self.functionName = self.tokens[1]
-
-    def generate(self, vmCmd):
-        #generate commandType, argOne, argTwo for a single command line
-        self.raw = vmCmd
-        self.tokens = vmCmd.split(" ")
-        self.genCommandType()
-        self.genArgOne()
-        self.genArgTwo()
-        self.genFunctionName()
+    def parse(self, line):
+        #parse a single line of vm code, returns None for a blank or comment line
+        raw = line.rstrip("\r\n")
+        tokens = raw.split("//", 1)[0].split()
+        if not tokens:
+            return None
+        entry = self.table.get(tokens[0])
+        if entry is None or len(tokens) != entry[2]:
+            raise ValueError("invalid vm command: {}".format(raw))
+        op, commandType, _, one, two = entry
+        tokens.append("")
+        if op == FUNCTION:
+            self.functionName = tokens[1]
+        return command(op, commandType, tokens[one], tokens[two], self.functionName, raw)
+
+    def parseFile(self, inf):
+        #iterate over the commands of an open .vm file, or any iterable of lines
+        for line in inf:
+            cmd = self.parse(line)
+            if cmd is not None:
+                yield cmd
 
 class codeWriter(object):
     '''
     codeWriter class to translate each vm command into assembly language command
-    by using commandType, argOne, argTwo information associated with each command
+    by using commandType, argOne, argTwo information associated with each command,
+    the assembly for every (command, segment) pair is joined into one text
+    template up front so a command costs a single fill of its template
     '''
-    def __init__(self, outname):
-        #take out filename from absolute/relative path and store it in self.outname
-        #it will be used for generate label name for static variables
+    #number of translated commands held in memory before a write to the file
+    BLOCK = 4096
+
+    def __init__(self, outname, optimize=False):
+        #take out filename from absolute/relative path and store it in self.outname,
+        #outname may also be an open file or any object with a write method
         self.outname = outname
-        #commandType, argOne, argTwo attributes have the same value with those
-        #associated with parser object
-        self.commandType = ""
-        self.argOne = ""
-        self.argTwo = ""
+        #when set, calls and returns jump to the shared routines of writeRoutines
+        #instead of inlining the frame handling at every call site and return
+        self.optimize = optimize
         self.className = ""
-        #a list for storing assembly language commands for each vm command line
-        self.asmCmd = []
         #a counter for recording index of continue label in assembly language,
         #used for generating continue labels for vm command of "eq", "lt", "gt"
+        #and return labels of "call"
         self.counter = 0
-        #output file
-        self.outf = open(self.outname, "w")
+        #put in front of continue labels to keep them apart when files are
+        #translated separately, see vmTranslator.TranslateParallel
+        self.labelPrefix = ""
+        #output file and the translated commands not written to it yet, a file
+        #handed over by the caller is left open by close
+        self.ownsFile = not hasattr(outname, "write")
+        self.outf = open(self.outname, "w") if self.ownsFile else outname
+        self.pending = []
+        #peepholeOptimizer the assembly goes through before the output file, if any
+        self.peephole = None
         #a directory mapping key words in vm command to corresponding key words
-        #in assembly language, default value set to be "self.outname.self.argTwo"
-        #for mapping static variables and its labels
+        #in assembly language, static variables are mapped to className + index
         self.d = {"temp0": "5",
                        "temp1": "6",
                        "temp2": "7",
@@ -108,275 +141,405 @@ class codeWriter(object):
                        "not": "!",
                        "and": "&",
                        "or": "|"}
+        self.templates = self.buildTemplates()
+
+    def buildTemplates(self):
+        #build the assembly template of every command, keyed by (opcode, name)
+        #where name is argOne for arithmetic, push, pop and branching commands
+        #and "" for the others; templates are filled by str.format with
+        #raw: vm command, arg: argTwo, target: argOne, function: functionName,
+        #address: ram address of a temp/pointer/static variable,
+        #counter: label counter, prefix: labelPrefix,
+        #locals: local variable initialization
+        def text(lines):
+            return "\n".join(lines) + "\n"
+
+        templates = {}
+        for op in ["add", "sub"]:
+            templates[ARITHMETIC, op] = text(["@SP",
+                                              "AM=M-1",
+                                              "D=M",
+                                              "A=A-1",
+                                              "M=M{}D".format(self.d[op])])
+        for op in ["eq", "lt", "gt"]:
+            templates[ARITHMETIC, op] = text(["@SP",
+                                              "AM=M-1",
+                                              "D=M",
+                                              "A=A-1",
+                                              "D=M-D",
+                                              "M=-1",
+                                              "@{prefix}CONTINUE{counter}",
+                                              "D;{}".format(self.d[op]),
+                                              "@SP",
+                                              "A=M-1",
+                                              "M=0",
+                                              "({prefix}CONTINUE{counter})"])
+        for op in ["neg", "not"]:
+            templates[ARITHMETIC, op] = text(["@SP",
+                                              "A=M-1",
+                                              "M={}M".format(self.d[op])])
+        for op in ["and", "or"]:
+            templates[ARITHMETIC, op] = text(["@SP",
+                                              "AM=M-1",
+                                              "D=M",
+                                              "A=A-1",
+                                              "M=D{}M".format(self.d[op])])
+
+        templates[PUSH, "constant"] = text(["@{arg}",
+                                            "D=A",
+                                            "@SP",
+                                            "A=M",
+                                            "M=D",
+                                            "@SP",
+                                            "M=M+1"])
+        for segment in ["local", "argument", "this", "that"]:
+            templates[PUSH, segment] = text(["@{arg}",
+                                             "D=A",
+                                             "@" + self.d[segment],
+                                             "A=D+M",
+                                             "D=M",
+                                             "@SP",
+                                             "AM=M+1",
+                                             "A=A-1",
+                                             "M=D"])
+            templates[POP, segment] = text(["@{arg}",
+                                            "D=A",
+                                            "@" + self.d[segment],
+                                            "M=D+M",
+                                            "@SP",
+                                            "AM=M-1",
+                                            "D=M",
+                                            "@" + self.d[segment],
+                                            "A=M",
+                                            "M=D",
+                                            "@{arg}",
+                                            "D=A",
+                                            "@" + self.d[segment],
+                                            "M=M-D"])
+        for segment in ["temp", "pointer", "static"]:
+            templates[PUSH, segment] = text(["@{address}",
+                                             "D=M",
+                                             "@SP",
+                                             "AM=M+1",
+                                             "A=A-1",
+                                             "M=D"])
+            templates[POP, segment] = text(["@SP",
+                                            "AM=M-1",
+                                            "D=M",
+                                            "@{address}",
+                                            "M=D"])
+
+        templates[BRANCHING, "label"] = text(["({function}${arg})"])
+        templates[BRANCHING, "goto"] = text(["@{function}${arg}",
+                                             "0;JMP"])
+        templates[BRANCHING, "if-goto"] = text(["@SP",
+                                                "AM=M-1",
+                                                "D=M",
+                                                "@{function}${arg}",
+                                                "D;JNE"])
+
+        call = ["//push returnAddr",
+                "@{function}$ret.{counter}",
+                "D=A",
+                "@SP",
+                "AM=M+1",
+                "A=A-1",
+                "M=D"]
+        for key in ["LCL", "ARG", "THIS", "THAT"]:
+            call.extend(["//push {}".format(key),
+                         "@{}".format(key),
+                         "D=M",
+                         "@SP",
+                         "AM=M+1",
+                         "A=A-1",
+                         "M=D"])
+        call.extend(["//ARG = SP - 5 - n",
+                     "@SP",
+                     "D=M",
+                     "@5",
+                     "D=D-A",
+                     "@{arg}",
+                     "D=D-A",
+                     "@ARG",
+                     "M=D",
+                     "//LCL = SP",
+                     "@SP",
+                     "D=M",
+                     "@LCL",
+                     "M=D",
+                     "//goto functionName",
+                     "@{target}",
+                     "0;JMP",
+                     "({function}$ret.{counter})"])
+        templates[CALL, ""] = text(call)
+
+        #"{locals}" carries the code zeroing each local variable
+        templates[FUNCTION, ""] = "({function})\n{locals}"
+
+        ret = ["// endFrame = LCL",
+               "@LCL",
+               "D=M",
+               "@endFrame",
+               "M=D",
+               "// returnAddr = *(endFrame - 5)",
+               "@endFrame",
+               "D=M",
+               "@5",
+               "A=D-A",
+               "D=M",
+               "@returnAddr",
+               "M=D",
+               "// *ARG = pop()",
+               "@SP",
+               "A=M-1",
+               "D=M",
+               "@ARG",
+               "A=M",
+               "M=D",
+               "// SP = ARG + 1",
+               "@ARG",
+               "D=M+1",
+               "@SP",
+               "M=D"]
+        for i, key in enumerate(["THAT", "THIS", "ARG", "LCL"]):
+            ret.extend(["//{} = *(endFrame-{})".format(key, i+1),
+                        "@endFrame",
+                        "D=M",
+                        "@{}".format(i+1),
+                        "A=D-A",
+                        "D=M",
+                        "@{}".format(key),
+                        "M=D"])
+        ret.extend(["//goto returnAddr",
+                    "@returnAddr",
+                    "A=M",
+                    "0;JMP"])
+        templates[RETURN, ""] = text(ret)
+
+        templates[BOOTSTRAP, ""] = text(["@256",
+                                         "D=A",
+                                         "@SP",
+                                         "M=D"])
+
+        if self.optimize:
+            #call site passes function in R13, nArgs in R14, return address in D
+            templates[CALL, ""] = text(["@{target}",
+                                        "D=A",
+                                        "@R13",
+                                        "M=D",
+                                        "@{arg}",
+                                        "D=A",
+                                        "@R14",
+                                        "M=D",
+                                        "@{function}$ret.{counter}",
+                                        "D=A",
+                                        "@$$CALL",
+                                        "0;JMP",
+                                        "({function}$ret.{counter})"])
+            templates[RETURN, ""] = text(["@$$RETURN",
+                                          "0;JMP"])
 
-    def writeCmd(self, parser):
-        #set commandType, argOne, argTwo, functionName to be same with those of parser object
-        self.commandType = parser.commandType
-        self.argOne = parser.argOne
-        self.argTwo = parser.argTwo
-        self.functionName = parser.functionName
         #add raw command as comment at the top of block of assembly command
         #for debugging purpose
-        self.asmCmd = ["// {}".format(parser.raw)]
-
-        if self.commandType == "arithmetic":
-            self.writeArithmetic()
-        elif self.commandType == "push":
-            self.writePush()
-        elif self.commandType == "pop":
-            self.writePop()
-        elif self.commandType == "branching":
-            self.writeBranching()
-        elif self.commandType == "call":
-            self.writeCall()
-        elif self.commandType == "function":
-            self.writeFunction()
-        elif self.commandType == "return":
-            self.writeReturn()
-        elif self.commandType == "bootstrap":
-            self.writeInit()
-
-    def writeArithmetic(self):
-        #method that calls different code generation methods according to
-        #individual arithmetic type
-        if self.argOne in {"add", "sub"}:
-            self.add_sub()
-        elif self.argOne in {"eq", "lt", "gt"}:
-            self.eq_lt_gt()
-        elif self.argOne in {"neg", "not"}:
-            self.neg_not()
-        elif self.argOne in {"and", "or"}:
-            self.and_or()
-
-    def add_sub(self):
-        #generate asm code for "add" or "sub" command
-        self.asmCmd.extend(["@SP",
-                            "AM=M-1",
-                            "D=M",
-                            "A=A-1",
-                            "M=M{}D".format(self.d[self.argOne])])
-
-    def eq_lt_gt(self):
-        #generate asm code for "eq", "lt" or "gt" command
-        self.asmCmd.extend(["@SP",
-                            "AM=M-1",
-                            "D=M",
-                            "A=A-1",
-                            "D=M-D",
-                            "M=-1",
-                            "@CONTINUE{}".format(self.counter),
-                            "D;{}".format(self.d[self.argOne]),
-                            "@SP",
-                            "A=M-1",
-                            "M=0",
-                            "(CONTINUE{})".format(self.counter)])
-        #increment continue_counter by 1 for generating next continue label
-        self.counter += 1
-
-    def neg_not(self):
-        #generate asm code for "neg" or "not" command
-        self.asmCmd.extend(["@SP",
-                            "A=M-1",
-                            "M={}M".format(self.d[self.argOne])])
-
-    def and_or(self):
-        #generate asm code for "and" or "or" command
-        self.asmCmd.extend(["@SP",
-                            "AM=M-1",
-                            "D=M",
-                            "A=A-1",
-                            "M=D{}M".format(self.d[self.argOne])])
-
-    def writePush(self):
-        #generate asm code for push command
-        #case "constant"
-        if self.argOne == "constant":
-            self.asmCmd.extend(["@{}".format(self.argTwo),
-                                "D=A",
-                                "@SP",
-                                "A=M",
-                                "M=D",
-                                "@SP",
-                                "M=M+1"])
-        #case "local", "argument", "this", "that"
-        elif self.argOne in {"local", "argument", "this", "that"}:
-            self.asmCmd.extend(["@{}".format(self.argTwo),
-                                "D=A",
-                                "@{}".format(self.d[self.argOne]),
-                                "A=D+M",
-                                "D=M",
-                                "@SP",
-                                "AM=M+1",
-                                "A=A-1",
-                                "M=D"])
-        #case "temp", "pointer", "static"
-        elif self.argOne in {"temp", "pointer", "static"}:
-            self.asmCmd.extend(["@{}".format(self.className + self.argTwo \
-                                if self.argOne == "static" \
-                                else self.d[self.argOne + self.argTwo]),
-                                "D=M",
-                                "@SP",
-                                "AM=M+1",
-                                "A=A-1",
-                                "M=D"])
-
-    def writePop(self):
-        #generate asm code for pop command
-        #case "local", "argument", "this", "that"
-        if self.argOne in {"local", "argument", "this", "that"}:
-            self.asmCmd.extend(["@{}".format(self.argTwo),
-                                "D=A",
-                                "@{}".format(self.d[self.argOne]),
-                                "M=D+M",
-                                "@SP",
-                                "AM=M-1",
-                                "D=M",
-                                "@{}".format(self.d[self.argOne]),
-                                "A=M",
-                                "M=D",
-                                "@{}".format(self.argTwo),
-                                "D=A",
-                                "@{}".format(self.d[self.argOne]),
-                                "M=M-D"])
-        #case "temp", "pointer", "static"
-        elif self.argOne in {"temp", "pointer", "static"}:
-            self.asmCmd.extend(["@SP",
-                                "AM=M-1",
-                                "D=M",
-                                "@{}".format(self.className + self.argTwo \
-                                if self.argOne == "static" \
-                                else self.d[self.argOne + self.argTwo]),
-                                "M=D"])
-
-    def writeBranching(self):
-        #generate asm code for vm command with commandType "branching"
-        if self.argOne == "label":
-            self.label()
-        elif self.argOne == "goto":
-            self.goto()
-        elif self.argOne == "if-goto":
-            self.if_goto()
-
-    def label(self):
-        #generate asm code for "label label"
-        self.asmCmd.extend(["({}${})".format(self.functionName, self.argTwo)])
-
-    def goto(self):
-        #generate asm code for "goto label"
-        self.asmCmd.extend(["@{}${}".format(self.functionName, self.argTwo),
-                            "0;JMP"])
-
-    def if_goto(self):
-        #generate asm code for "if-goto"
-        self.asmCmd.extend(["@SP",
-                            "AM=M-1",
-                            "D=M",
-                            "@{}${}".format(self.functionName, self.argTwo),
-                            "D;JNE"])
-
-    def writeCall(self):
-        #generate asm code for "call function nArgs"
-        self.asmCmd.extend(["//push returnAddr",
-                            "@{}$ret.{}".format(self.functionName, self.counter),
-                            "D=A",
-                            "@SP",
-                            "AM=M+1",
-                            "A=A-1",
-                            "M=D"])
+        return dict((key, "// {raw}\n" + template) for key, template in templates.items())
+
+    def translate(self, cmd):
+        #translate a single vm command into its block of assembly text
+        #arithmetic, push, pop and branching opcodes come first and pick
+        #their template by argOne
+        name = cmd.argOne if cmd.op <= BRANCHING else ""
+        template = self.templates.get((cmd.op, name))
+        if template is None:
+            raise ValueError("invalid vm command: {}".format(cmd.raw))
+        address = initLocals = ""
+        if name in {"temp", "pointer", "static"}:
+            if name == "static":
+                address = self.className + cmd.argTwo
+            elif name + cmd.argTwo in self.d:
+                address = self.d[name + cmd.argTwo]
+            else:
+                raise ValueError("invalid vm command: {}".format(cmd.raw))
+        elif cmd.op == FUNCTION:
+            initLocals = "@SP\nAM=M+1\nA=A-1\nM=0\n" * int(cmd.argTwo)
+        counter = self.counter
+        if cmd.op == CALL or name in {"eq", "lt", "gt"}:
+            #increment counter by 1 for generating next continue/return label
+            self.counter += 1
+        return template.format(raw=cmd.raw, arg=cmd.argTwo, target=cmd.argOne,
+                               function=cmd.functionName, address=address,
+                               counter=counter, prefix=self.labelPrefix, locals=initLocals)
+
+    def writeRoutines(self):
+        #generate asm code for the call and return routines shared by every
+        #call site and return in optimize mode
+        routines = ["// shared call routine, R13 = function, R14 = nArgs, D = returnAddr",
+                    "($$CALL)",
+                    "@SP",
+                    "AM=M+1",
+                    "A=A-1",
+                    "M=D"]
         for key in ["LCL", "ARG", "THIS", "THAT"]:
-            self.asmCmd.extend(["//push {}".format(key),
-                                "@{}".format(key),
-                                "D=M",
-                                "@SP",
-                                "AM=M+1",
-                                "A=A-1",
-                                "M=D"])
-        self.asmCmd.extend(["//ARG = SP - 5 - n",
-                            "@SP",
-                            "D=M",
-                            "@5",
-                            "D=D-A",
-                            "@{}".format(self.argTwo),
-                            "D=D-A",
-                            "@ARG",
-                            "M=D",
-                            "//LCL = SP",
-                            "@SP",
-                            "D=M",
-                            "@LCL",
-                            "M=D",
-                            "//goto functionName",
-                            "@{}".format(self.argOne),
-                            "0;JMP",
-                            "({}$ret.{})".format(self.functionName, self.counter)])
-        self.counter += 1
-
-    def writeFunction(self):
-        #generate asm code for "function function nLcls"
-        self.asmCmd.extend(["({})".format(self.functionName)])
-        for i in range(int(self.argTwo)):
-            self.asmCmd.extend(["@SP",
-                                "AM=M+1",
-                                "A=A-1",
-                                "M=0"])
-
-    def writeReturn(self):
-        #generate asm code for "return"
-        self.asmCmd.extend(["// endFrame = LCL",
-                            "@LCL",
-                            "D=M",
-                            "@endFrame",
-                            "M=D",
-                            "// returnAddr = *(endFrame - 5)",
-                            "@endFrame",
-                            "D=M",
-                            "@5",
-                            "A=D-A",
-                            "D=M",
-                            "@returnAddr",
-                            "M=D",
-                            "// *ARG = pop()",
-                            "@SP",
-                            "A=M-1",
-                            "D=M",
-                            "@ARG",
-                            "A=M",
-                            "M=D",
-                            "// SP = ARG + 1",
-                            "@ARG",
-                            "D=M+1",
-                            "@SP",
-                            "M=D"])
-        for i, key in enumerate(["THAT", "THIS", "ARG", "LCL"]):
-            self.asmCmd.extend(["//{} = *(endFrame-{})".format(key, i+1),
-                                "@endFrame",
-                                "D=M",
-                                "@{}".format(i+1),
-                                "A=D-A",
-                                "D=M",
-                                "@{}".format(key),
-                                "M=D"])
-        self.asmCmd.extend(["//goto returnAddr",
-                            "@returnAddr",
-                            "A=M",
-                            "0;JMP"])
-
-    def writeInit(self):
-        #generate asm code for "bootstrap"
-        self.asmCmd.extend(["@256",
-                            "D=A",
-                            "@SP",
-                            "M=D"])
+            routines.extend(["//push {}".format(key),
+                             "@{}".format(key),
+                             "D=M",
+                             "@SP",
+                             "AM=M+1",
+                             "A=A-1",
+                             "M=D"])
+        routines.extend(["//ARG = SP - 5 - n",
+                         "@SP",
+                         "D=M",
+                         "@5",
+                         "D=D-A",
+                         "@R14",
+                         "D=D-M",
+                         "@ARG",
+                         "M=D",
+                         "//LCL = SP",
+                         "@SP",
+                         "D=M",
+                         "@LCL",
+                         "M=D",
+                         "//goto function",
+                         "@R13",
+                         "A=M",
+                         "0;JMP",
+                         "// shared return routine, R13 = endFrame, R14 = returnAddr",
+                         "($$RETURN)",
+                         "@LCL",
+                         "D=M",
+                         "@R13",
+                         "M=D",
+                         "@5",
+                         "A=D-A",
+                         "D=M",
+                         "@R14",
+                         "M=D",
+                         "// *ARG = pop()",
+                         "@SP",
+                         "A=M-1",
+                         "D=M",
+                         "@ARG",
+                         "A=M",
+                         "M=D",
+                         "// SP = ARG + 1",
+                         "@ARG",
+                         "D=M+1",
+                         "@SP",
+                         "M=D"])
+        for key in ["THAT", "THIS", "ARG", "LCL"]:
+            routines.extend(["//{} = *(--endFrame)".format(key),
+                             "@R13",
+                             "AM=M-1",
+                             "D=M",
+                             "@{}".format(key),
+                             "M=D"])
+        routines.extend(["//goto returnAddr",
+                         "@R14",
+                         "A=M",
+                         "0;JMP"])
+        text = "\n".join(routines) + "\n"
+        if self.peephole is not None:
+            text = self.peephole.feedText(text)
+        self.pending.append(text)
+
+    def writeBootstrap(self):
+        #generate asm code setting up the stack and calling Sys.init, Sys.init
+        #never returns so the shared routines of optimize mode can follow it
+        for cmd in parser().parseFile(["bootstrap", "call Sys.init 0"]):
+            self.writeCmd(cmd)
+        if self.optimize:
+            self.writeRoutines()
+
+    def writeCmd(self, cmd):
+        #translate a single vm command, output is written in blocks of
+        #BLOCK commands
+        if self.peephole is not None:
+            self.pending.append(self.peephole.feed(cmd))
+        else:
+            self.pending.append(self.translate(cmd))
+        if len(self.pending) >= self.BLOCK:
+            self.flush()
+
+    def endFile(self):
+        #translate the commands the peephole optimizer holds back before
+        #className moves on to the next file
+        if self.peephole is not None:
+            self.pending.append(self.peephole.feedText(""))
+
+    def writeText(self, text):
+        #write asm text translated elsewhere, such as by another codeWriter,
+        #the peephole optimizer is flushed first and does not see the text
+        if self.peephole is not None:
+            self.pending.append(self.peephole.flush())
+        self.pending.append(text)
+
+    def flush(self):
+        #write the pending assembly text into output file
+        self.outf.write("".join(self.pending))
+        self.pending = []
 
     def close(self):
         #close output file
-        self.outf.close()
+        if self.peephole is not None:
+            self.pending.append(self.peephole.flush())
+        self.flush()
+        if self.ownsFile:
+            self.outf.close()
+
+class blockSink(object):
+    #file-like object keeping the blocks of text a codeWriter writes to it
+    #until translateStream hands them on
+    def __init__(self):
+        self.blocks = []
+
+    def write(self, text):
+        self.blocks.append(text)
+
+#class naming the static variables of vm code read by translateStream before
+#its first function, when no class is given
+STREAM_CLASS = "Stdin"
+
+def translateStream(lines, className=None, optimize=False, peephole=False, bootstrap=True,
+                    block=codeWriter.BLOCK):
+    #translate vm code read from any iterable of lines, such as an open file,
+    #sys.stdin or a generator, yielding the asm text in blocks of up to block
+    #commands; without className the class of each function, used to name
+    #its static variables, is taken from the function name, as in Main.main,
+    #and commands before the first function belong to STREAM_CLASS
+    sink = blockSink()
+    writer = codeWriter(sink, optimize)
+    writer.BLOCK = block
+    if peephole:
+        writer.peephole = peepholeOptimizer.peepholeOptimizer(writer)
+    if bootstrap:
+        writer.writeBootstrap()
+    writer.className = className or STREAM_CLASS
+    for cmd in parser().parseFile(lines):
+        if className is None and cmd.op == FUNCTION:
+            writer.endFile()
+            writer.className = cmd.argOne.split(".")[0]
+        writer.writeCmd(cmd)
+        if sink.blocks:
+            for text in sink.blocks:
+                yield text
+            sink.blocks = []
+    writer.close()
+    for text in sink.blocks:
+        if text:
+            yield text
 
 class vmTranslator(object):
     #vmTranslator class pieces parser and codeWriter together, constructor takes
     #the file path and file name to be translated, constructs parser and codeWriter
-    def __init__(self, path):
+    def __init__(self, path, optimize=False, peephole=False, link=False, jobs=1):
         self.path = path
+        #when set, only the functions reachable from Sys.init are translated
+        self.link = link
+        #number of processes translating files, see TranslateParallel
+        self.jobs = jobs
+        #number of functions in the program, and of functions translated
+        self.functions = self.translated = 0
         #setting self.outname to be the name of output file
         if path[-3:] == ".vm":
             self.outname = path[:-3] + ".asm"
@@ -384,15 +547,11 @@ class vmTranslator(object):
             self.outname = path + "/" + path.split("/")[-1] + ".asm"
         #construct parser and codeWriter
         self.parser = parser()
-        self.codeWriter = codeWriter(self.outname)
+        self.codeWriter = codeWriter(self.outname, optimize)
+        if peephole:
+            self.codeWriter.peephole = peepholeOptimizer.peepholeOptimizer(self.codeWriter)
         #adding bootstrap code
-        for raw in ["bootstrap", "call Sys.init 0"]:
-            #translate vm command into assembly command
-            self.parser.generate(raw)
-            self.codeWriter.writeCmd(self.parser)
-            #write assembly command into output file
-            for cmd in self.codeWriter.asmCmd:
-                self.codeWriter.outf.write(cmd + "\n")
+        self.codeWriter.writeBootstrap()
 
     def TranslateSingleFile(self, inputName):
         #method to translate a single file when there are multiple .vm in a directory
@@ -402,21 +561,78 @@ class vmTranslator(object):
             print("File not found or path is incorrect")
         else:
             with inf:
-                for row in inf:
-                    #skip if the input line is comment or empty line
-                    if row[:2] == "//" or row == "\r\n":
-                        continue
+                #comments and empty lines are skipped by the parser
+                for cmd in self.parser.parseFile(inf):
                     #translate vm command into assembly command
-                    self.parser.generate(row.replace("\r\n", ""))
-                    self.codeWriter.writeCmd(self.parser)
-                    #write assembly commands into output file
-                    for cmd in self.codeWriter.asmCmd:
-                        self.codeWriter.outf.write(cmd + "\n")
+                    self.codeWriter.writeCmd(cmd)
+            self.codeWriter.endFile()
+
+    def linkProgram(self, inputNames):
+        #parse every file and build the call graph of the program, returns
+        #(inputName, functions) for every file, commands ahead of the first
+        #function of a file forming a group of their own, and the names of
+        #the functions reachable from Sys.init, or of all functions when
+        #there is no Sys.init to start from
+        files = []
+        for inputName in inputNames:
+            with open(inputName, "r") as inf:
+                functions = []
+                for cmd in self.parser.parseFile(inf):
+                    if cmd.op == FUNCTION or not functions:
+                        functions.append([])
+                    functions[-1].append(cmd)
+            files.append((inputName, functions))
+        calls = callGraph([function for _, functions in files for function in functions])
+        reached = reachableFunctions(calls) if "Sys.init" in calls else set(calls)
+        self.functions, self.translated = len(calls), len(reached & set(calls))
+        return files, reached
+
+    def TranslateLinked(self, inputNames):
+        #method to translate the functions of all files reachable from Sys.init
+        files, reached = self.linkProgram(inputNames)
+        for inputName, functions in files:
+            self.codeWriter.className = inputName.split("/")[-1][:-3]
+            for function in functions:
+                if function[0].op != FUNCTION or function[0].argOne in reached:
+                    for cmd in function:
+                        self.codeWriter.writeCmd(cmd)
+            self.codeWriter.endFile()
+
+    def TranslateParallel(self, inputNames):
+        #method to translate every file in a worker of a process pool, each
+        #file gets its own label counter and continue label prefix so that its
+        #asm does not depend on the other files, the outputs follow the
+        #bootstrap in file name order
+        inputNames = sorted(inputNames)
+        reached = self.linkProgram(inputNames)[1] if self.link else None
+        peephole = self.codeWriter.peephole
+        jobs = [(inputName, self.codeWriter.optimize, peephole is not None, reached) \
+                for inputName in inputNames]
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            for text, saved, emitted in pool.imap(_translateFile, jobs):
+                self.codeWriter.writeText(text)
+                if peephole is not None:
+                    peephole.saved += saved
+                    peephole.emitted += emitted
+        finally:
+            pool.close()
+            pool.join()
 
     def Translator(self):
         #translate a single file or all .vm files within a directory
+        if self.jobs > 1:
+            if self.path[-3:] == ".vm":
+                self.TranslateParallel([self.path])
+            else:
+                self.TranslateParallel(glob.glob(os.path.join(self.path, '*.vm')))
+        elif self.link:
+            if self.path[-3:] == ".vm":
+                self.TranslateLinked([self.path])
+            else:
+                self.TranslateLinked(glob.glob(os.path.join(self.path, '*.vm')))
         #when translating a single file
-        if self.path[-3:] == ".vm":
+        elif self.path[-3:] == ".vm":
             #update className associated with a file
             self.codeWriter.className = self.path.split("/")[-1][:-3]
             self.TranslateSingleFile(self.path)
@@ -429,6 +645,55 @@ class vmTranslator(object):
 
         self.codeWriter.close()
 
+def _translateFile(job):
+    #translate a single .vm file in a worker process of TranslateParallel,
+    #returns the asm text and the peephole optimizer counts
+    inputName, optimize, peephole, reached = job
+    outf = io.StringIO()
+    writer = codeWriter(outf, optimize)
+    if peephole:
+        writer.peephole = peepholeOptimizer.peepholeOptimizer(writer)
+    writer.className = inputName.split("/")[-1][:-3]
+    writer.labelPrefix = writer.className + "$"
+    #function the commands belong to, None ahead of the first one
+    function = None
+    with open(inputName, "r") as inf:
+        for cmd in parser().parseFile(inf):
+            if cmd.op == FUNCTION:
+                function = cmd.argOne
+            if reached is None or function is None or function in reached:
+                writer.writeCmd(cmd)
+    writer.close()
+    if peephole:
+        return outf.getvalue(), writer.peephole.saved, writer.peephole.emitted
+    return outf.getvalue(), 0, 0
+
 if __name__ == "__main__":
-    vt = vmTranslator(sys.argv[1])
+    argParser = argparse.ArgumentParser(description="VM to Hack assembly translator")
+    argParser.add_argument("path", help=".vm file or directory of .vm files, "
+                           "- to translate standard input to standard output")
+    argParser.add_argument("--optimize", action="store_true",
+                           help="share one call and one return routine between all calls")
+    argParser.add_argument("--peephole", action="store_true",
+                           help="run the assembly through the peephole optimizer")
+    argParser.add_argument("--link", action="store_true",
+                           help="translate only the functions reachable from Sys.init")
+    argParser.add_argument("--jobs", type=int, default=1,
+                           help="number of processes translating files")
+    argParser.add_argument("--class", dest="className",
+                           help="with -, class of every static variable, by default the class "
+                           "of each function name and {} before the first".format(STREAM_CLASS))
+    args = argParser.parse_args()
+
+    if args.path == "-":
+        for text in translateStream(sys.stdin, args.className, args.optimize, args.peephole):
+            sys.stdout.write(text)
+        sys.exit(0)
+
+    vt = vmTranslator(args.path, args.optimize, args.peephole, args.link, args.jobs)
     vt.Translator()
+    if args.link:
+        print("link: {} of {} functions translated".format(vt.translated, vt.functions))
+    if args.peephole:
+        peephole = vt.codeWriter.peephole
+        print("peephole: {} instructions written, {} saved".format(peephole.emitted, peephole.saved))
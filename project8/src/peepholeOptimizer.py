@@ -0,0 +1,195 @@
+class peepholeOptimizer(object):
+    '''
+    peepholeOptimizer sits between codeWriter.writeCmd and the output file,
+    it looks at a sliding window of vm commands, where pushes feeding an
+    "add", a "sub" or a pop are fused with them, and at a sliding window of
+    asm lines, where a value pushed by one command and popped right away by
+    the next no longer goes through the stack and repeated loads of A
+    are dropped
+    '''
+    #binary arithmetic commands folded when both operands are constants
+    fold = {"add": lambda x, y: x + y,
+            "sub": lambda x, y: x - y,
+            "and": lambda x, y: x & y,
+            "or": lambda x, y: x | y}
+    #tails of the push templates leaving the pushed value in D, and the head
+    #of a pop taking the value on top of the stack into D
+    PUSH_D = ["@SP", "AM=M+1", "A=A-1", "M=D"]
+    PUSH_CONSTANT = ["@SP", "A=M", "M=D", "@SP", "M=M+1"]
+    POP_D = ["@SP", "AM=M-1", "D=M"]
+    #(pattern, replacement, reload) over the last instructions, reload marks
+    #rules leaving A different, only applied when the next instruction loads A
+    rules = [(PUSH_D + POP_D, [], True),
+             (PUSH_CONSTANT + POP_D, [], True),
+             (POP_D + PUSH_D, ["@SP", "A=M-1", "D=M"], False),
+             (PUSH_D + ["@SP", "A=M-1"], PUSH_D, False)]
+    #last instructions of the patterns
+    ends = set(pattern[-1] for pattern, replacement, reload in rules)
+    #instructions kept back for the rules, older ones move on to the A tracker
+    KEEP = 32
+
+    def __init__(self, writer):
+        #codeWriter translating the commands
+        self.writer = writer
+        #pushes held back waiting for the command after them
+        self.window = []
+        #instructions and labels held back for the rules, the comments written
+        #before each of them, and comments not followed by an instruction yet
+        self.lines = []
+        self.notes = []
+        self.comments = []
+        #symbol or number known to be in A at the end of the lines passed on,
+        #None when unknown
+        self.known = None
+        #instructions removed, and instructions written
+        self.saved = 0
+        self.emitted = 0
+
+    def feed(self, cmd):
+        #take a single vm command, returns the asm text ready to be written
+        out = []
+        if cmd.commandType == "push":
+            self.window.append(cmd)
+            if len(self.window) > 2:
+                out.append(self.writer.translate(self.window.pop(0)))
+            return self.asm("".join(out))
+        if cmd.argOne in self.fold and len(self.window) == 2 and \
+                all(push.argOne == "constant" for push in self.window):
+            first, second = self.window
+            value = self.fold[cmd.argOne](int(first.argTwo), int(second.argTwo))
+            if 0 <= value <= 32767:
+                #the folded push stays in the window for the command after it
+                raw = " / ".join([first.raw, second.raw, cmd.raw])
+                folded = first._replace(argTwo=str(value), raw=raw)
+                self.saved += self.count([self.writer.translate(c) for c in (first, second, cmd)]) - \
+                              self.count([self.writer.translate(folded)])
+                self.window = [folded]
+                return ""
+        if self.window and cmd.argOne in {"add", "sub"} and self.window[-1].argOne == "constant":
+            out.extend(self.flushWindow(1))
+            out.append(self.fuse(self.window.pop(), cmd, self.addConstant))
+        elif self.window and cmd.commandType == "pop" and cmd.argOne in {"local", "argument", "this", "that"}:
+            out.extend(self.flushWindow(1))
+            out.append(self.fuse(self.window.pop(), cmd, self.move))
+        else:
+            out.extend(self.flushWindow())
+            out.append(self.writer.translate(cmd))
+        return self.asm("".join(out))
+
+    def feedText(self, text):
+        #take asm text written without a vm command, such as shared routines
+        return self.asm("".join(self.flushWindow()) + text)
+
+    def flush(self):
+        #returns the asm text of everything still held back
+        text = self.asm("".join(self.flushWindow()))
+        self.applyRules(True)
+        text += self.passOn(len(self.lines))
+        if self.comments:
+            text += "\n".join(self.comments) + "\n"
+            self.comments = []
+        #whatever follows may be reached with anything in A
+        self.known = None
+        return text
+
+    def flushWindow(self, keep=0):
+        #translate the pushes held back, except for the last keep of them
+        out = [self.writer.translate(push) for push in self.window[:len(self.window) - keep]]
+        del self.window[:len(self.window) - keep]
+        return out
+
+    def fuse(self, push, cmd, generate):
+        #translate push followed by cmd into the asm text built by generate
+        text = generate(push, cmd)
+        self.saved += self.count([self.writer.translate(push), self.writer.translate(cmd)]) - self.count([text])
+        return text
+
+    def load(self, push):
+        #asm text of a push command stopping with the value in D
+        lines = self.writer.translate(push).split("\n")[:-1]
+        drop = len(self.PUSH_CONSTANT) if push.argOne == "constant" else len(self.PUSH_D)
+        return "\n".join(lines[:-drop]) + "\n"
+
+    def addConstant(self, push, cmd):
+        #"push constant c" then "add" or "sub" works on the top of the stack in place
+        text = "// {}\n// {}\n".format(push.raw, cmd.raw)
+        value = int(push.argTwo)
+        op = "+" if cmd.argOne == "add" else "-"
+        if value == 0:
+            return text
+        if value == 1:
+            return text + "@SP\nA=M-1\nM=M{}1\n".format(op)
+        return text + "@{}\nD=A\n@SP\nA=M-1\n{}\n".format(value, "M=D+M" if op == "+" else "M=M-D")
+
+    def move(self, push, pop):
+        #"push x" then "pop segment i" stores the value of x straight into
+        #segment i, the address goes through R13 when i is too large to reach
+        #by incrementing A
+        base = self.writer.d[pop.argOne]
+        index = int(pop.argTwo)
+        if index <= 6:
+            return self.load(push) + "// {}\n@{}\nA=M\n{}M=D\n".format(pop.raw, base, "A=A+1\n" * index)
+        return "// {}\n@{}\nD=A\n@{}\nD=D+M\n@R13\nM=D\n".format(pop.raw, index, base) + \
+               self.load(push) + "@R13\nA=M\nM=D\n"
+
+    def count(self, texts):
+        #number of instructions in asm texts, comments and labels excluded
+        return sum(1 for text in texts for line in text.split("\n") if line and line[0] not in "/(")
+
+    def asm(self, text):
+        #run asm text through the rules, returns the lines moving out of the window
+        for line in text.split("\n")[:-1]:
+            if line[0] == "/":
+                self.comments.append(line)
+                continue
+            if line[0] in "@(":
+                self.applyRules(True)
+            self.lines.append(line)
+            self.notes.append(self.comments)
+            self.comments = []
+            if line in self.ends:
+                self.applyRules(False)
+        if len(self.lines) <= 2 * self.KEEP:
+            return ""
+        return self.passOn(len(self.lines) - self.KEEP)
+
+    def applyRules(self, reload):
+        #apply the first matching rule to the last instructions held back,
+        #labels never match a pattern so rules do not reach across them
+        for pattern, replacement, needsReload in self.rules:
+            if needsReload == reload and self.lines[-len(pattern):] == pattern:
+                #comments of the removed instructions go with what follows
+                notes = [comment for notes in self.notes[-len(pattern):] for comment in notes]
+                del self.lines[-len(pattern):]
+                del self.notes[-len(pattern):]
+                if replacement:
+                    self.lines.extend(replacement)
+                    self.notes.extend([notes] + [[]] * (len(replacement) - 1))
+                else:
+                    self.comments = notes + self.comments
+                self.saved += len(pattern) - len(replacement)
+                return True
+        return False
+
+    def passOn(self, count):
+        #move the first count lines held back out of the window, dropping loads
+        #of a value A already holds, returns their text
+        out = []
+        for line, notes in zip(self.lines[:count], self.notes[:count]):
+            out.extend(notes)
+            if line[0] == "@":
+                if line == self.known:
+                    self.saved += 1
+                    continue
+                self.known = line
+                self.emitted += 1
+            elif line[0] == "(":
+                self.known = None
+            else:
+                if "=" in line and "A" in line.split("=")[0]:
+                    self.known = None
+                self.emitted += 1
+            out.append(line)
+        del self.lines[:count]
+        del self.notes[:count]
+        return "\n".join(out) + "\n" if out else ""
@@ -0,0 +1,223 @@
+import argparse
+import glob
+import os
+import VMTranslator
+from VMTranslator import ARITHMETIC, PUSH, POP, BRANCHING, CALL, FUNCTION, RETURN
+
+#folding of the arithmetic commands over 16-bit values, comparisons are
+#made on the signed values as the vm language defines them
+def signed(x):
+    return x - 65536 if x & 0x8000 else x
+
+unaryOps = {"neg": lambda x: -x,
+            "not": lambda x: ~x}
+binaryOps = {"add": lambda x, y: x + y,
+             "sub": lambda x, y: x - y,
+             "and": lambda x, y: x & y,
+             "or": lambda x, y: x | y,
+             "eq": lambda x, y: -1 if x == y else 0,
+             "gt": lambda x, y: -1 if signed(x) > signed(y) else 0,
+             "lt": lambda x, y: -1 if signed(x) < signed(y) else 0}
+
+def vmText(cmd):
+    #line of vm code for a command record
+    if cmd.op in (PUSH, POP, CALL, FUNCTION):
+        return "{} {} {}".format(cmd.commandType, cmd.argOne, cmd.argTwo)
+    if cmd.op == BRANCHING:
+        return "{} {}".format(cmd.argOne, cmd.argTwo)
+    return cmd.argOne or cmd.commandType
+
+class vmOptimizer(object):
+    '''
+    vmOptimizer is an optimization stage for vm code, ahead of any backend:
+    every .vm file of a program is loaded into a list of command records,
+    each function is split into basic blocks linked by label/goto/if-goto,
+    constant expressions are folded, blocks no path reaches are dropped and
+    functions no chain of calls from Sys.init reaches are removed
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.parser = VMTranslator.parser()
+        #(file name, [function]) for every file of the program, a function
+        #being the list of its commands starting at "function", commands
+        #ahead of the first function of a file form a function of their own
+        self.files = []
+        if path[-3:] == ".vm":
+            filenames = [path]
+        else:
+            filenames = glob.glob(os.path.join(path, "*.vm"))
+        for filename in filenames:
+            with open(filename, "r") as inf:
+                functions = []
+                for cmd in self.parser.parseFile(inf):
+                    if cmd.op == FUNCTION or not functions:
+                        functions.append([])
+                    functions[-1].append(cmd)
+            self.files.append((os.path.basename(filename), functions))
+        #number of commands and functions before and after optimize
+        self.before = self.after = self.size()
+        self.functionsBefore = self.functionsAfter = self.functionCount()
+
+    def size(self):
+        return sum(len(function) for _, functions in self.files for function in functions)
+
+    def functionCount(self):
+        return sum(1 for _, functions in self.files for function in functions if function[0].op == FUNCTION)
+
+    def make(self, text, functionName):
+        #command record for a line of vm code generated by the optimizer
+        return self.parser.parse(text)._replace(functionName=functionName)
+
+    def optimize(self):
+        #run every pass, functions are simplified first so that calls made
+        #only from dead code no longer keep their callee alive
+        for _, functions in self.files:
+            for i, function in enumerate(functions):
+                while True:
+                    size = len(function)
+                    function = self.removeDeadCode(self.foldConstants(function))
+                    if len(function) == size:
+                        break
+                functions[i] = function
+        self.removeDeadFunctions()
+        self.after = self.size()
+        self.functionsAfter = self.functionCount()
+
+    def constantAt(self, out, end):
+        #(value, number of commands) of the constant expression ending at
+        #out[end - 1], "push constant c" possibly followed by "neg" or "not"
+        if end >= 1 and out[end - 1].op == PUSH and out[end - 1].argOne == "constant":
+            return int(out[end - 1].argTwo) & 0xFFFF, 1
+        if end >= 2 and out[end - 1].op == ARITHMETIC and out[end - 1].argOne in unaryOps:
+            value = self.constantAt(out, end - 1)
+            if value is not None and value[1] == 1:
+                return unaryOps[out[end - 1].argOne](value[0]) & 0xFFFF, 2
+        return None
+
+    def pushConstant(self, value, functionName):
+        #shortest commands pushing a 16-bit value
+        if value <= 32767:
+            return [self.make("push constant {}".format(value), functionName)]
+        return [self.make("push constant {}".format(~value & 0xFFFF), functionName),
+                self.make("not", functionName)]
+
+    def foldConstants(self, function):
+        #fold arithmetic on constants and if-goto on a constant condition
+        out = []
+        for cmd in function:
+            if cmd.op == ARITHMETIC and cmd.argOne in unaryOps:
+                x = self.constantAt(out, len(out))
+                if x is not None:
+                    del out[-x[1]:]
+                    out.extend(self.pushConstant(unaryOps[cmd.argOne](x[0]) & 0xFFFF, cmd.functionName))
+                    continue
+            elif cmd.op == ARITHMETIC:
+                y = self.constantAt(out, len(out))
+                x = self.constantAt(out, len(out) - y[1]) if y is not None else None
+                if x is not None and y is not None:
+                    del out[-(x[1] + y[1]):]
+                    value = binaryOps[cmd.argOne](x[0], y[0]) & 0xFFFF
+                    out.extend(self.pushConstant(value, cmd.functionName))
+                    continue
+                #x + 0, x - 0, x | 0 and x & -1 leave x
+                if y is not None and (y[0], cmd.argOne) in {(0, "add"), (0, "sub"), (0, "or"), (0xFFFF, "and")}:
+                    del out[-y[1]:]
+                    continue
+            elif cmd.op == BRANCHING and cmd.argOne == "if-goto":
+                x = self.constantAt(out, len(out))
+                if x is not None:
+                    del out[-x[1]:]
+                    if x[0]:
+                        out.append(self.make("goto " + cmd.argTwo, cmd.functionName))
+                    continue
+            out.append(cmd)
+        return out
+
+    def blocks(self, function):
+        #split a function into basic blocks, a block starts at a label or
+        #after a goto, an if-goto or a return
+        blocks = [[]]
+        for cmd in function:
+            if cmd.op == BRANCHING and cmd.argOne == "label" and blocks[-1]:
+                blocks.append([])
+            blocks[-1].append(cmd)
+            if cmd.op == RETURN or (cmd.op == BRANCHING and cmd.argOne != "label"):
+                blocks.append([])
+        if not blocks[-1]:
+            blocks.pop()
+        return blocks
+
+    def removeDeadCode(self, function):
+        #keep the blocks reachable from the function entry in the control
+        #flow graph, then drop gotos to the next command and unused labels
+        blocks = self.blocks(function)
+        labels = dict((block[0].argTwo, i) for i, block in enumerate(blocks) \
+                      if block[0].op == BRANCHING and block[0].argOne == "label")
+        reached = set()
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if i in reached or i >= len(blocks):
+                continue
+            reached.add(i)
+            last = blocks[i][-1]
+            if last.op == BRANCHING and last.argOne in {"goto", "if-goto"}:
+                if last.argTwo not in labels:
+                    #jump out of the function, leave it as it is
+                    return function
+                stack.append(labels[last.argTwo])
+            if last.op != RETURN and not (last.op == BRANCHING and last.argOne == "goto"):
+                stack.append(i + 1)
+        function = [cmd for i, block in enumerate(blocks) if i in reached for cmd in block]
+
+        out = []
+        for i, cmd in enumerate(function):
+            if cmd.op == BRANCHING and cmd.argOne == "goto" and i + 1 < len(function) and \
+                    function[i + 1].op == BRANCHING and function[i + 1].argOne == "label" and \
+                    function[i + 1].argTwo == cmd.argTwo:
+                continue
+            out.append(cmd)
+        targets = set(cmd.argTwo for cmd in out if cmd.op == BRANCHING and cmd.argOne != "label")
+        return [cmd for cmd in out if not (cmd.op == BRANCHING and cmd.argOne == "label" \
+                                           and cmd.argTwo not in targets)]
+
+    def removeDeadFunctions(self):
+        #remove the functions no chain of calls from Sys.init reaches, the
+        #program is left as it is when it has no Sys.init or when a single
+        #file is optimized, other files may call any of its functions
+        if self.path[-3:] == ".vm":
+            return
+        calls = VMTranslator.callGraph([function for _, functions in self.files for function in functions])
+        if "Sys.init" not in calls:
+            return
+        reached = VMTranslator.reachableFunctions(calls)
+        for _, functions in self.files:
+            functions[:] = [function for function in functions \
+                            if function[0].op != FUNCTION or function[0].argOne in reached]
+
+    def write(self, outpath):
+        #write the optimized program, into outpath as a .vm file when the
+        #input is a single file, into the directory outpath otherwise
+        if self.path[-3:] == ".vm":
+            outnames = [outpath]
+        else:
+            if not os.path.isdir(outpath):
+                os.makedirs(outpath)
+            outnames = [os.path.join(outpath, filename) for filename, _ in self.files]
+        for outname, (_, functions) in zip(outnames, self.files):
+            with open(outname, "w") as outf:
+                for function in functions:
+                    for cmd in function:
+                        outf.write(vmText(cmd) + "\n")
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="VM code optimizer")
+    argParser.add_argument("path", help=".vm file or directory of .vm files")
+    argParser.add_argument("outpath", help="optimized .vm file, or directory for the optimized files")
+    args = argParser.parse_args()
+
+    vo = vmOptimizer(args.path)
+    vo.optimize()
+    vo.write(args.outpath)
+    print("{} commands -> {}, {} functions -> {}".format(vo.before, vo.after,
+                                                          vo.functionsBefore, vo.functionsAfter))